@@ -0,0 +1,669 @@
+"""
+Offline benchmark for the migration scripts.
+
+Generates synthetic `messages` and `conversations` documents and runs the
+real mapping, batching and load code of migrate_messages.py and
+migrate_conversations.py against in-process stand-ins for MongoDB, ScyllaDB
+and PostgreSQL. Statements are still bound and serialized (with the driver's
+own type serializers, or psycopg2's adapters), so the numbers cover all the
+client-side work of a run; only the network and the servers are left out.
+
+Reports docs/sec, statements/sec, peak RSS and the functions taking the most
+time. Results can be saved as a baseline; later runs are compared against it
+so throughput regressions are visible.
+
+Usage:
+    python benchmark.py --messages 200000 --conversations 5000 \
+        --reactions 3 --receipts 8 --edit-history 20 --hot-conversations 0.01 \
+        --batch-size 1000 --save-baseline
+
+    # Compare a tuning change against the saved baseline:
+    python benchmark.py --messages 200000 --conversations 5000 --batch-size 2000
+
+    # Check the columnar transform against the row transform, then time it:
+    python benchmark.py --messages 200000 --check-columnar --columnar-transform
+
+    # Time extract + transform alone, without binding or serializing:
+    python benchmark.py --messages 200000 --sink null
+"""
+
+import argparse
+import cProfile
+import itertools
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import resource
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import bson
+import psycopg2.extensions
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+from cassandra.cqltypes import BooleanType, DateType, SetType, UTF8Type, UUIDType
+from cassandra.protocol import ColumnMetadata
+from cassandra.query import BatchStatement, PreparedStatement
+
+import migrate_conversations
+import migrate_messages
+from sinks import NullSink
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# Relative docs/sec drop against the baseline reported as a regression.
+DEFAULT_TOLERANCE = 0.10
+
+# ScyllaDB column types of the migrated tables (see scylladb/schema.cql).
+COLUMN_TYPES = {
+    "conversation_id": UTF8Type,
+    "created_at": DateType,
+    "message_id": UUIDType,
+    "sender_id": UTF8Type,
+    "type": UTF8Type,
+    "content": UTF8Type,
+    "reply_to_id": UUIDType,
+    "mentions": SetType.apply_parameters([UTF8Type]),
+    "attachments": UTF8Type,
+    "is_edited": BooleanType,
+    "is_deleted": BooleanType,
+    "deleted_by": UTF8Type,
+    "deleted_for": SetType.apply_parameters([UTF8Type]),
+    "edited_at": DateType,
+    "edit_history": UTF8Type,
+    "is_forwarded": BooleanType,
+    "client_id": UTF8Type,
+    "metadata": UTF8Type,
+    "emoji": UTF8Type,
+    "user_id": UTF8Type,
+    "last_read_at": DateType,
+    "last_read_msg": UUIDType,
+    "delivered_at": DateType,
+}
+
+EMOJI = ("👍", "❤️", "😂", "🎉", "😮", "🙏")
+WORDS = (
+    "hello", "meeting", "tomorrow", "ship", "review", "thanks", "lunch", "deploy",
+    "call", "later", "build", "green", "merge", "today", "sounds", "good",
+)
+
+_INSERT_PATTERN = re.compile(r"INSERT INTO (\w+)\s*\(([^)]*)\)", re.S)
+
+
+# ---------------------------------------------------------------------------
+# Synthetic data
+# ---------------------------------------------------------------------------
+
+def _object_id(created_at, sequence):
+    """Deterministic, increasing ObjectId."""
+    return ObjectId(int(created_at.timestamp()).to_bytes(4, "big") + sequence.to_bytes(8, "big"))
+
+
+def _text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _conversation_sizes(rng, conversations, hot_ratio):
+    """Weights giving `hot_ratio` of conversations half of all messages."""
+    hot = max(1, int(conversations * hot_ratio)) if hot_ratio > 0 else 0
+    cold = conversations - hot
+    weights = [0.5 / hot] * hot + [(0.5 if hot else 1.0) / max(cold, 1)] * cold
+    rng.shuffle(weights)
+    return weights
+
+
+def generate_messages(count, conversations, reactions, receipts, edit_history,
+                      hot_ratio, seed):
+    """Yield synthetic `messages` documents in `_id` order."""
+    rng = random.Random(seed)
+    cum_weights = list(itertools.accumulate(_conversation_sizes(rng, conversations, hot_ratio)))
+    conversation_ids = [f"conv-{i:07d}" for i in range(conversations)]
+    users = [f"user-{i:06d}" for i in range(max(receipts * 4, 50))]
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    for i in range(count):
+        created_at = start + timedelta(seconds=i)
+        sender = rng.choice(users)
+        doc = {
+            "_id": _object_id(created_at, i),
+            "conversation_id": rng.choices(conversation_ids, cum_weights=cum_weights)[0],
+            "created_at": created_at,
+            "sender_id": sender,
+            "type": "text",
+            "content": _text(rng, rng.randint(1, 40)),
+            "mentions": rng.sample(users, rng.randint(0, 2)),
+            "reactions": [
+                {"emoji": rng.choice(EMOJI), "user_id": rng.choice(users), "created_at": created_at}
+                for _ in range(rng.randint(0, reactions * 2))
+            ],
+            "delivered_to": [
+                {"user_id": user, "delivered_at": created_at + timedelta(seconds=1)}
+                for user in rng.sample(users, rng.randint(0, receipts * 2))
+            ],
+            "read_by": [
+                {"user_id": user, "read_at": created_at + timedelta(seconds=5)}
+                for user in rng.sample(users, rng.randint(0, receipts * 2))
+            ],
+        }
+        if rng.random() < 0.05:
+            doc["attachments"] = [{
+                "id": ObjectId(rng.randbytes(12)), "file_type": "image", "file_name": "photo.jpg",
+                "file_size": rng.randint(10_000, 5_000_000), "url": "https://cdn.example.com/f",
+                "thumbnail_url": "https://cdn.example.com/t",
+            }]
+        if edit_history and rng.random() < 0.1:
+            doc["edited"] = True
+            doc["edited_at"] = created_at + timedelta(minutes=5)
+            doc["edit_history"] = [
+                {"content": _text(rng, 10), "edited_at": created_at + timedelta(seconds=j)}
+                for j in range(rng.randint(1, edit_history))
+            ]
+        yield doc
+
+
+def generate_conversations(count, receipts, seed):
+    """Yield synthetic `conversations` documents in `_id` order."""
+    rng = random.Random(seed)
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    for i in range(count):
+        created_at = start + timedelta(minutes=i)
+        group = rng.random() < 0.3
+        participants = rng.randint(3, receipts * 4) if group else 2
+        yield {
+            "_id": _object_id(created_at, i),
+            "type": "group" if group else "direct",
+            "name": _text(rng, 3) if group else None,
+            "creator": f"user-{rng.randint(0, 9999):06d}",
+            "isArchived": rng.random() < 0.05,
+            "lastMessage": {
+                "content": _text(rng, 12), "senderId": "user-000001", "createdAt": created_at,
+            },
+            "metadata": {"pinned": rng.random() < 0.1, "theme": "default"},
+            "participants": [
+                {
+                    "userId": f"user-{rng.randint(0, 99999):06d}",
+                    "role": "admin" if j == 0 else "member",
+                    "unreadCount": rng.randint(0, 50),
+                    "lastReadAt": created_at,
+                    "joinedAt": created_at,
+                }
+                for j in range(participants)
+            ],
+            "createdAt": created_at,
+            "updatedAt": created_at,
+        }
+
+
+# ---------------------------------------------------------------------------
+# Stand-ins
+# ---------------------------------------------------------------------------
+
+class FakeCursor:
+    """Cursor over pre-encoded documents, decoded as RawBSONDocument."""
+
+    def __init__(self, encoded, codec_options):
+        self.encoded = encoded
+        self.codec_options = codec_options
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def __iter__(self):
+        for data in self.encoded:
+            yield RawBSONDocument(data, self.codec_options)
+
+
+class FakeCollection:
+    """The subset of a pymongo Collection used by the migration scans."""
+
+    def __init__(self, name, encoded, codec_options=None):
+        self.name = name
+        self.encoded = encoded
+        self.codec_options = codec_options or migrate_messages.RAW_CODEC_OPTIONS
+
+    def estimated_document_count(self):
+        return len(self.encoded)
+
+    def with_options(self, codec_options=None, **kwargs):
+        return FakeCollection(self.name, self.encoded, codec_options or self.codec_options)
+
+    def find(self, query=None, projection=None):
+        # Synthetic documents only hold projected fields; no filtering needed.
+        return FakeCursor(self.encoded, self.codec_options)
+
+
+class FakeResponseFuture:
+    """Already-completed ResponseFuture."""
+
+    def add_callbacks(self, callback, errback, callback_args=(), errback_args=()):
+        callback([], *callback_args)
+
+
+class FakeScyllaSession:
+    """
+    Session whose prepared statements serialize values with the driver's
+    real CQL types, and whose writes complete immediately.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.statements = 0
+
+    def prepare(self, query):
+        match = _INSERT_PATTERN.search(query)
+        columns = [column.strip() for column in match.group(2).split(",")]
+        metadata = [
+            ColumnMetadata("benchmark", match.group(1), column, COLUMN_TYPES[column])
+            for column in columns
+        ]
+        return PreparedStatement(metadata, b"benchmark", [0], query, "benchmark", 4, None, None)
+
+    def execute_async(self, request):
+        self.requests += 1
+        if isinstance(request, BatchStatement):
+            self.statements += len(request._statements_and_parameters)
+        else:
+            self.statements += 1
+        return FakeResponseFuture()
+
+
+class FakePgCursor:
+    """Cursor that renders statements with psycopg2's adapters and drops them."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def mogrify(self, sql, params):
+        quoted = {}
+        for key, value in params.items():
+            adapted = psycopg2.extensions.adapt(value)
+            if hasattr(adapted, "encoding"):
+                adapted.encoding = "utf8"
+            quoted[key] = adapted.getquoted().decode("utf-8")
+        self.connection.statements += 1
+        return (sql % quoted).encode("utf-8")
+
+    def execute(self, sql, params=None):
+        self.connection.requests += 1
+
+    def copy_expert(self, sql, buffer):
+        self.connection.requests += 1
+        self.connection.statements += buffer.getvalue().count("\n")
+
+    def close(self):
+        pass
+
+
+class FakePgConnection:
+    """The subset of a psycopg2 connection used by migrate_conversations."""
+
+    def __init__(self):
+        self.requests = 0
+        self.statements = 0
+
+    def cursor(self):
+        return FakePgCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class CountingNullSink(NullSink):
+    """NullSink counting its writes as requests and rows as statements."""
+
+    def __init__(self):
+        super().__init__()
+        self.requests = 0
+
+    @property
+    def statements(self):
+        return self.rows
+
+    def write(self, table, partition_key, rows, source_ids=()):
+        self.requests += 1
+        super().write(table, partition_key, rows, source_ids)
+
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and in bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def bench_messages(args, encoded):
+    """Run migrate_messages over `encoded`; returns (docs, target)."""
+    if args.sink == "null":
+        target = sink = CountingNullSink()
+    else:
+        target = FakeScyllaSession()
+        sink = migrate_messages.ScyllaSink(
+            target, migrate_messages.prepare_statements(target),
+            args.max_batch_bytes, args.max_in_flight,
+        )
+    mongo_db = {"messages": FakeCollection("messages", encoded)}
+    migrated = migrate_messages.migrate_messages(
+        mongo_db, sink, args.batch_size, transform_workers=args.transform_workers,
+        columnar=args.columnar_transform,
+        deferred_rows=migrate_messages.DeferredRows() if args.sender_second_pass else None,
+    )
+    return migrated, target
+
+
+def bench_conversations(args, encoded):
+    """Run migrate_conversations over `encoded`; returns (docs, target)."""
+    if args.sink == "null":
+        target = sink = CountingNullSink()
+    else:
+        target = FakePgConnection()
+        sink = migrate_conversations.PostgresSink(target, args.load_mode)
+    mongo_db = {"conversations": FakeCollection("conversations", encoded)}
+    migrated, _ = migrate_conversations.migrate_conversations(
+        mongo_db, sink, args.conversation_batch_size,
+    )
+    return migrated, target
+
+
+def serialized_rows(prepared, mapped):
+    """Bound values of every row of `mapped` (_id, rows) pairs, in order."""
+    buffer = migrate_messages.PartitionBuffer()
+    tracker = migrate_messages.ReadReceiptStore()
+    for doc_id, rows in mapped:
+        migrate_messages.add_message_rows(buffer, tracker, rows, doc_id)
+    values = [
+        tuple(prepared[migrate_messages.TABLES[table][0]].bind(row).values)
+        for table, _, table_rows, _ in buffer.drain()
+        for row in table_rows
+    ]
+    values.extend(tracker.items())
+    tracker.cleanup()
+    return values
+
+
+def check_columnar(args, encoded):
+    """
+    Compare the bound values of the columnar transform with the row transform.
+
+    Returns the number of cursor batches whose output differs.
+    """
+    prepared = migrate_messages.prepare_statements(FakeScyllaSession())
+    mismatches = 0
+    for start in range(0, len(encoded), args.batch_size):
+        chunk = encoded[start:start + args.batch_size]
+        expected = serialized_rows(prepared, migrate_messages.transform_chunk(chunk))
+        actual = serialized_rows(prepared, migrate_messages.map_message_batch(chunk))
+        if actual != expected:
+            mismatches += 1
+            logger.warning("Columnar transform differs in documents %d-%d", start, start + len(chunk) - 1)
+    logger.info(
+        "Columnar transform check: %d of %d batches differ",
+        mismatches, -(-len(encoded) // args.batch_size),
+    )
+    return mismatches
+
+
+def run(name, bench, args, encoded):
+    """Time one benchmark, then profile it; returns a result dict."""
+    started = time.perf_counter()
+    docs, target = bench(args, encoded)
+    elapsed = time.perf_counter() - started
+
+    result = {
+        "docs": docs,
+        "seconds": round(elapsed, 3),
+        "docs_per_sec": round(docs / elapsed, 1),
+        "statements": target.statements,
+        "statements_per_sec": round(target.statements / elapsed, 1),
+        "requests": target.requests,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+    if args.top:
+        profiler = cProfile.Profile()
+        profiler.runcall(bench, args, encoded)
+        stats = pstats.Stats(profiler)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+        result["functions"] = [
+            {
+                "function": f"{os.path.basename(filename)}:{line}({function})",
+                "calls": calls,
+                "self_seconds": round(tottime, 3),
+                "cumulative_seconds": round(cumtime, 3),
+            }
+            for (filename, line, function), (_, calls, tottime, cumtime, _) in rows[:args.top]
+        ]
+
+    logger.info(
+        "%s: %d docs in %.2fs -> %.0f docs/s, %d statements (%.0f/s) in %d requests, peak RSS %.0f MiB",
+        name, docs, elapsed, result["docs_per_sec"], target.statements,
+        result["statements_per_sec"], target.requests, result["peak_rss_mb"],
+    )
+    for row in result.get("functions", []):
+        logger.info(
+            "    %8.3fs self %8.3fs cum %9d calls  %s",
+            row["self_seconds"], row["cumulative_seconds"], row["calls"], row["function"],
+        )
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Log throughput against the baseline; returns the number of regressions."""
+    regressions = 0
+    for name, result in results.items():
+        reference = baseline.get("results", {}).get(name)
+        if reference is None:
+            continue
+        change = result["docs_per_sec"] / reference["docs_per_sec"] - 1
+        if change < -tolerance:
+            regressions += 1
+            logger.warning(
+                "%s REGRESSION: %.0f docs/s vs baseline %.0f (%+.1f%%)",
+                name, result["docs_per_sec"], reference["docs_per_sec"], change * 100,
+            )
+        else:
+            logger.info(
+                "%s: %.0f docs/s vs baseline %.0f (%+.1f%%)",
+                name, result["docs_per_sec"], reference["docs_per_sec"], change * 100,
+            )
+    return regressions
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the migration scripts offline on synthetic data",
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=100_000,
+        help="Synthetic messages to generate (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--conversations",
+        type=int,
+        default=2_000,
+        help="Synthetic conversations to generate (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--reactions",
+        type=int,
+        default=2,
+        help="Mean reactions per message (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--receipts",
+        type=int,
+        default=5,
+        help="Mean delivery and read receipts per message (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--edit-history",
+        type=int,
+        default=10,
+        help="Maximum edit history length of an edited message (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--hot-conversations",
+        type=float,
+        default=0.01,
+        help="Fraction of conversations receiving half of all messages (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=42,
+        help="Random seed of the data generator (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="migrate_messages --batch-size (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-batch-bytes",
+        type=int,
+        default=migrate_messages.DEFAULT_MAX_BATCH_BYTES,
+        help="migrate_messages --max-batch-bytes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=migrate_messages.DEFAULT_MAX_IN_FLIGHT,
+        help="migrate_messages --max-in-flight (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--transform-workers",
+        type=int,
+        default=0,
+        help="migrate_messages --transform-workers (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--sink",
+        choices=("db", "null"),
+        default="db",
+        help="Bind and serialize rows for the fake databases, or drop them "
+             "unbound like --sink null (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--columnar-transform",
+        action="store_true",
+        help="migrate_messages --columnar-transform",
+    )
+    parser.add_argument(
+        "--sender-second-pass",
+        action="store_true",
+        help="migrate_messages --sender-second-pass",
+    )
+    parser.add_argument(
+        "--check-columnar",
+        action="store_true",
+        help="Check that the columnar transform binds exactly the same bytes "
+             "as the row transform, and fail if it does not",
+    )
+    parser.add_argument(
+        "--conversation-batch-size",
+        type=int,
+        default=500,
+        help="migrate_conversations --batch-size (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--load-mode",
+        choices=migrate_conversations.LOAD_MODES,
+        default="insert",
+        help="migrate_conversations --load-mode (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=15,
+        help="Functions listed from a profiled run, 0 to skip profiling (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=DEFAULT_BASELINE,
+        help="Baseline results file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store this run's results as the new baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="docs/s drop against the baseline reported as a regression (default: %(default)s)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Keep the scripts' own progress lines out of the report.
+    logging.getLogger(migrate_messages.__name__).setLevel(logging.WARNING)
+    logging.getLogger(migrate_conversations.__name__).setLevel(logging.WARNING)
+
+    logger.info("Generating %d messages and %d conversations", args.messages, args.conversations)
+    messages = [
+        bson.encode(doc) for doc in generate_messages(
+            args.messages, args.conversations, args.reactions, args.receipts,
+            args.edit_history, args.hot_conversations, args.seed,
+        )
+    ]
+    conversations = [
+        bson.encode(doc) for doc in generate_conversations(args.conversations, args.receipts, args.seed)
+    ]
+
+    if args.check_columnar and check_columnar(args, messages):
+        sys.exit(1)
+
+    results = {
+        "messages": run("messages", bench_messages, args, messages),
+        "conversations": run("conversations", bench_conversations, args, conversations),
+    }
+    settings = {
+        key: value for key, value in vars(args).items()
+        if key not in ("baseline", "save_baseline", "tolerance", "top", "check_columnar")
+    }
+
+    regressions = 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as fh:
+            baseline = json.load(fh)
+        if baseline.get("settings") != settings:
+            logger.info("Baseline was recorded with different settings: %s", baseline.get("settings"))
+        regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump({"settings": settings, "results": results}, fh, indent=2)
+            fh.write("\n")
+        logger.info("Saved baseline to %s", args.baseline)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Change-stream catch-up ("follow") mode shared by the migration scripts.
+
+The resume token is taken before the bulk scan starts, so every write that
+lands in MongoDB while the backfill runs is replayed afterwards. Changes are
+applied in micro-batches by a script-specific callback; after each batch the
+new resume token is handed to `on_token` so progress can be persisted.
+"""
+
+import logging
+import time
+
+from checkpoint import raise_if_stopped
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of change events applied together.
+DEFAULT_FOLLOW_BATCH_SIZE = 500
+
+# How long a getMore waits for new events before the pending batch is applied.
+DEFAULT_MAX_AWAIT_MS = 1000
+
+
+def start_token(collection):
+    """Open a change stream on `collection` and return its current resume token."""
+    with collection.watch() as stream:
+        # The token is only populated once the server has answered a getMore.
+        stream.try_next()
+        token = stream.resume_token
+    logger.info("Recorded change stream resume token for '%s'", collection.name)
+    return token
+
+
+def change_lag(change):
+    """Seconds between a change's cluster time and now."""
+    cluster_time = change.get("clusterTime")
+    if cluster_time is None:
+        return 0.0
+    return max(0.0, time.time() - cluster_time.time)
+
+
+def follow(collection, resume_token, apply_batch, batch_size=DEFAULT_FOLLOW_BATCH_SIZE,
+           max_await_ms=DEFAULT_MAX_AWAIT_MS, stop_when_caught_up=False, on_token=None):
+    """
+    Tail `collection` from `resume_token`, calling `apply_batch(changes)`.
+
+    Full documents are looked up for updates, and pre-images are requested
+    when the collection has them enabled, so deletes can be applied to
+    tables keyed by document fields. Runs until interrupted (a stop requested
+    with checkpoint.request_stop included), or until the stream has no
+    pending events when `stop_when_caught_up` is set.
+
+    Returns the number of change events applied.
+    """
+    applied = 0
+    caught_up = False
+
+    with collection.watch(
+        resume_after=resume_token,
+        full_document="updateLookup",
+        full_document_before_change="whenAvailable",
+        max_await_time_ms=max_await_ms,
+        batch_size=batch_size,
+    ) as stream:
+        batch = []
+        while stream.alive:
+            # A pending batch is dropped; its events are after the saved token.
+            raise_if_stopped()
+            change = stream.try_next()
+            if change is not None:
+                batch.append(change)
+                if len(batch) < batch_size:
+                    continue
+
+            if batch:
+                apply_batch(batch)
+                applied += len(batch)
+                lag = change_lag(batch[-1])
+                logger.info(
+                    "Follow '%s': applied %d changes (%d total), lag %.1fs",
+                    collection.name, len(batch), applied, lag,
+                )
+                batch = []
+                caught_up = False
+                if on_token is not None:
+                    on_token(stream.resume_token)
+                continue
+
+            if not caught_up:
+                caught_up = True
+                logger.info("Follow '%s': caught up, lag 0s (%d changes applied)", collection.name, applied)
+                if on_token is not None:
+                    on_token(stream.resume_token)
+            if stop_when_caught_up:
+                break
+
+    return applied
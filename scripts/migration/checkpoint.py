@@ -0,0 +1,193 @@
+"""
+Durable progress checkpoints for long-running migrations.
+
+A checkpoint directory holds the `_id` ranges of the run (`ranges.json`), the
+change stream resume token for follow mode (`follow.json`), a marker once the
+bulk copy has fully finished (`complete.json`) and,
+per shard, the last `_id` whose writes were fully acknowledged
+(`shard-NNNN.json`) plus any aggregation state that has to survive a restart
+(`shard-NNNN.state.pickle`, with spill files under `shard-NNNN.spill/`).
+Stores in the state are spilled to their runs before it is pickled, so the
+pickle only holds run paths and counters. Files are replaced atomically, so
+a crash mid-write leaves the previous checkpoint intact.
+"""
+
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import signal
+import threading
+import time
+
+from bson import json_util
+
+logger = logging.getLogger(__name__)
+
+# Minimum number of seconds between two checkpoint writes.
+DEFAULT_CHECKPOINT_INTERVAL = 30
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, path)
+
+
+def reset_checkpoints(directory):
+    """Create `directory` and remove checkpoint files from a previous run."""
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and name.startswith("shard-"):
+            shutil.rmtree(path)
+        elif name in ("ranges.json", "follow.json", "complete.json") or name.startswith("shard-"):
+            os.remove(path)
+
+
+def save_ranges(directory, ranges):
+    """Persist the `_id` ranges so a resumed run reuses the same shards."""
+    os.makedirs(directory, exist_ok=True)
+    payload = json_util.dumps([list(id_range) for id_range in ranges])
+    _write_atomic(os.path.join(directory, "ranges.json"), payload.encode("utf-8"))
+
+
+def load_ranges(directory):
+    """Return the persisted `_id` ranges, or None if there are none."""
+    path = os.path.join(directory, "ranges.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as fh:
+        return [tuple(id_range) for id_range in json_util.loads(fh.read())]
+
+
+def save_follow_token(directory, token):
+    """Persist the change stream resume token used by follow mode."""
+    os.makedirs(directory, exist_ok=True)
+    _write_atomic(os.path.join(directory, "follow.json"), json_util.dumps(token).encode("utf-8"))
+
+
+def load_follow_token(directory):
+    """Return the persisted change stream resume token, or None."""
+    path = os.path.join(directory, "follow.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as fh:
+        return json_util.loads(fh.read())
+
+
+def mark_complete(directory, migrated, **counts):
+    """
+    Record that the bulk copy, including its final writes, has finished.
+
+    `counts` are further totals of the run stored alongside `migrated`. The
+    shards' aggregation state and spill files are no longer needed once the
+    marker is written, so they are removed.
+    """
+    os.makedirs(directory, exist_ok=True)
+    payload = json_util.dumps({"migrated": migrated, **counts})
+    _write_atomic(os.path.join(directory, "complete.json"), payload.encode("utf-8"))
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith("shard-") and name.endswith(".spill") and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif name.startswith("shard-") and name.endswith(".state.pickle"):
+            os.remove(path)
+
+
+def load_complete(directory):
+    """Return the completion marker (`migrated`) or None if still running."""
+    path = os.path.join(directory, "complete.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as fh:
+        return json_util.loads(fh.read())
+
+
+class ShardCheckpoint:
+    """
+    Checkpoint of a single `_id` range.
+
+    ``save`` is rate-limited to one write per ``interval`` seconds unless
+    forced, because the aggregation state can be large.
+    """
+
+    def __init__(self, directory, shard_index, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.position_path = os.path.join(directory, f"shard-{shard_index:04d}.json")
+        self.state_path = os.path.join(directory, f"shard-{shard_index:04d}.state.pickle")
+        self.spill_dir = os.path.join(directory, f"shard-{shard_index:04d}.spill")
+        self._last_saved = 0.0
+
+    def load(self):
+        """Return the saved position (`last_id`, `migrated`, `done`) or None."""
+        if not os.path.exists(self.position_path):
+            return None
+        with open(self.position_path, "r", encoding="utf-8") as fh:
+            return json_util.loads(fh.read())
+
+    def load_state(self, default=None):
+        """Return the saved aggregation state, or `default` if there is none."""
+        if not os.path.exists(self.state_path):
+            return default
+        with open(self.state_path, "rb") as fh:
+            return pickle.load(fh)
+
+    def save(self, last_id, migrated, state=None, done=False, force=False):
+        """
+        Record `last_id` as fully acknowledged; returns True if written.
+
+        `state` is a tuple; stores in it (anything with a `spill` method)
+        are spilled to their runs first, so it pickles to run paths only.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_saved < self.interval:
+            return False
+
+        os.makedirs(self.directory, exist_ok=True)
+        # State first: a position must never point past the state saved with it.
+        if state is not None:
+            for store in state:
+                if hasattr(store, "spill"):
+                    store.spill()
+            _write_atomic(self.state_path, pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+        position = {"last_id": last_id, "migrated": migrated, "done": done}
+        _write_atomic(self.position_path, json_util.dumps(position).encode("utf-8"))
+
+        self._last_saved = now
+        logger.debug("Checkpoint %s: last_id=%s migrated=%d", self.position_path, last_id, migrated)
+        return True
+
+
+# Set once a stop is requested. Signals only interrupt the main thread, so
+# migrations running in other threads poll this at their flush points.
+_stop_requested = threading.Event()
+
+
+def request_stop():
+    """Ask every migration in this process, and its worker processes, to stop."""
+    _stop_requested.set()
+    # Forward to worker processes so each one drains and checkpoints too.
+    for child in multiprocessing.active_children():
+        child.terminate()
+
+
+def raise_if_stopped():
+    """Raise KeyboardInterrupt once request_stop has been called."""
+    if _stop_requested.is_set():
+        raise KeyboardInterrupt("stop requested")
+
+
+def _handle_sigterm(signum, frame):
+    request_stop()
+    raise KeyboardInterrupt(f"received signal {signum}")
+
+
+def install_sigterm_handler():
+    """Turn SIGTERM into KeyboardInterrupt so migrations shut down cleanly."""
+    signal.signal(signal.SIGTERM, _handle_sigterm)
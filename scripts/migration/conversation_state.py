@@ -0,0 +1,337 @@
+"""
+PostgreSQL conversation state derived from the messages scan, used by
+migrate_messages.py (--postgres-state-uri).
+
+migrate_conversations.py copies messaging.conversations.last_message_* and
+messaging.participants.last_read_at/unread_count from fields MongoDB keeps
+denormalised on each conversation. The messages scan sees every message
+and every read, so it can derive them instead:
+  - the last message of a conversation is its latest `created_at` (the
+    later `_id` on a tie);
+  - a user's last read is the read receipt tracker's position;
+  - a user's unread count is the number of messages created after that
+    position that the user did not send, or all messages the user did not
+    send when there is no read.
+
+A ConversationState keeps the latest message per conversation and the
+(created_at, message_id, sender_id) position of every message, both in
+DeferredRows stores, so memory stays bounded. write_conversation_state
+merges them with the read receipts, conversation by conversation, COPYs
+the results into temporary tables and updates both PostgreSQL tables with
+set-based UPDATE ... FROM statements in one transaction.
+
+The rows have to exist already, so run migrate_conversations.py first.
+Only rows whose values change are updated. updated_at keeps its migrated
+value: the transaction runs with core.DISABLE_TRIGGERS, so the updated_at
+trigger on messaging.conversations does not restamp them.
+"""
+
+import bisect
+import itertools
+import logging
+import os
+from io import StringIO
+
+from core import DISABLE_TRIGGERS, objectid_to_uuid
+from deferred import DEFAULT_SPILL_MEMORY_MB, DeferredRows, iter_deferred_rows
+from receipts import EPOCH, ONE_MICROSECOND
+from sinks import copy_text
+
+logger = logging.getLogger(__name__)
+
+# Rows sent per COPY into the temporary tables.
+COPY_ROWS = 50_000
+
+# Approximate cost of one latest-message entry besides its text values.
+LATEST_BYTES = 300
+
+STATE_CONVERSATION_COLUMNS = (
+    "id", "last_message_at", "last_message_preview", "last_message_sender_id", "message_count",
+)
+STATE_PARTICIPANT_COLUMNS = ("conversation_id", "user_id", "last_read_at", "unread_count")
+
+CREATE_STATE_TABLES = """
+    CREATE TEMP TABLE conversation_state (
+        id                     UUID PRIMARY KEY,
+        last_message_at        TIMESTAMPTZ,
+        last_message_preview   TEXT,
+        last_message_sender_id VARCHAR(100),
+        message_count          INTEGER NOT NULL
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE participant_state (
+        conversation_id UUID         NOT NULL,
+        user_id         VARCHAR(100) NOT NULL,
+        last_read_at    TIMESTAMPTZ,
+        unread_count    INTEGER      NOT NULL,
+        PRIMARY KEY (conversation_id, user_id)
+    ) ON COMMIT DROP;
+"""
+
+UPDATE_CONVERSATIONS = """
+    UPDATE messaging.conversations AS c
+    SET last_message_at = s.last_message_at,
+        last_message_preview = s.last_message_preview,
+        last_message_sender_id = s.last_message_sender_id,
+        updated_at = c.updated_at
+    FROM conversation_state AS s
+    WHERE c.id = s.id
+      AND (c.last_message_at, c.last_message_preview, c.last_message_sender_id)
+          IS DISTINCT FROM (s.last_message_at, s.last_message_preview, s.last_message_sender_id)
+"""
+
+# Users without a read keep their last_read_at.
+UPDATE_PARTICIPANTS = """
+    UPDATE messaging.participants AS p
+    SET last_read_at = COALESCE(s.last_read_at, p.last_read_at),
+        unread_count = s.unread_count
+    FROM participant_state AS s
+    WHERE p.conversation_id = s.conversation_id AND p.user_id = s.user_id
+      AND (p.last_read_at, p.unread_count)
+          IS DISTINCT FROM (COALESCE(s.last_read_at, p.last_read_at), s.unread_count)
+"""
+
+# Participants that neither sent nor read a message have every message unread.
+UPDATE_SILENT_PARTICIPANTS = """
+    UPDATE messaging.participants AS p
+    SET unread_count = s.message_count
+    FROM conversation_state AS s
+    WHERE p.conversation_id = s.id
+      AND p.unread_count IS DISTINCT FROM s.message_count
+      AND NOT EXISTS (
+          SELECT 1 FROM participant_state AS ps
+          WHERE ps.conversation_id = p.conversation_id AND ps.user_id = p.user_id
+      )
+"""
+
+
+def _micros(value):
+    return (value - EPOCH) // ONE_MICROSECOND
+
+
+class ConversationState:
+    """
+    Latest message and message positions per conversation, from one scan.
+
+    ``memory_mb`` is split between the two DeferredRows stores, which spill
+    sorted runs under ``spill_dir`` (private temporary directories when none
+    is given). Picklable like the stores, so it can be checkpointed or
+    returned from worker processes.
+    """
+
+    def __init__(self, spill_dir=None, memory_mb=DEFAULT_SPILL_MEMORY_MB):
+        half_mb = max(1, memory_mb // 2)
+        self.memory_mb = memory_mb
+        self.max_latest_bytes = half_mb * 1024 * 1024
+        self._latest = {}
+        self._latest_bytes = 0
+        self._latest_rows = DeferredRows(
+            os.path.join(spill_dir, "latest") if spill_dir is not None else None, half_mb,
+        )
+        self._positions = DeferredRows(
+            os.path.join(spill_dir, "positions") if spill_dir is not None else None, half_mb,
+        )
+
+    def __len__(self):
+        """Messages recorded (re-scanned duplicates included)."""
+        return len(self._positions)
+
+    def set_memory_mb(self, memory_mb):
+        """Apply the memory budget of this run to a restored state."""
+        self.memory_mb = memory_mb
+        self.max_latest_bytes = max(1, memory_mb // 2) * 1024 * 1024
+        self._latest_rows.max_bytes = self.max_latest_bytes
+        self._positions.max_bytes = self.max_latest_bytes
+
+    def update(self, conversation_id, created_at, message_id, sender_id, content, source_id):
+        """Record one message; `source_id` is its `_id`, which breaks ties in time."""
+        if not conversation_id or created_at is None:
+            return
+        micros = _micros(created_at)
+        self._positions.add("positions", (conversation_id, micros, message_id, sender_id))
+
+        latest = self._latest.get(conversation_id)
+        if latest is not None and (micros, source_id) < (latest[0], latest[1]):
+            return
+        self._latest[conversation_id] = (micros, source_id, sender_id, content)
+        if latest is None:
+            self._latest_bytes += LATEST_BYTES + len(conversation_id) + len(content or "")
+            if self._latest_bytes >= self.max_latest_bytes:
+                self._move_latest()
+                self._latest_rows.spill()
+
+    def _move_latest(self):
+        # Conversations seen again later get a second record; readers keep the latest.
+        for conversation_id, latest in self._latest.items():
+            self._latest_rows.add("latest", (conversation_id, *latest))
+        self._latest = {}
+        self._latest_bytes = 0
+
+    def spill(self):
+        """Write everything held in memory to sorted runs."""
+        self._move_latest()
+        self._latest_rows.spill()
+        self._positions.spill()
+
+    def cleanup(self):
+        """Remove spill files the stores created themselves."""
+        self._latest_rows.cleanup()
+        self._positions.cleanup()
+
+
+def _iter_latest(states):
+    """Yield (conversation_id, micros, sender_id, content) of each conversation, sorted."""
+    for state in states:
+        state._move_latest()
+    records = iter_deferred_rows([state._latest_rows for state in states])
+    for conversation_id, group in itertools.groupby(records, key=lambda record: record[1][0]):
+        _, micros, _, sender_id, content = max(
+            (record[1] for record in group), key=lambda row: (row[1], row[2]),
+        )
+        yield conversation_id, micros, sender_id, content
+
+
+def _iter_positions(states):
+    """Yield (conversation_id, [(micros, sender_id), ...]) sorted by conversation and time."""
+    records = iter_deferred_rows([state._positions for state in states])
+    for conversation_id, group in itertools.groupby(records, key=lambda record: record[1][0]):
+        positions = []
+        previous = None
+        for _, row in group:
+            # Documents re-scanned after a resume were recorded twice.
+            if row != previous:
+                positions.append((row[1], row[3]))
+                previous = row
+        yield conversation_id, positions
+
+
+def participant_state(positions, reads):
+    """
+    (user_id, last_read_at, unread_count) of every sender and reader.
+
+    `positions` are the conversation's (micros, sender_id) in time order and
+    `reads` maps user ids to their last read_at.
+    """
+    times = [micros for micros, _ in positions]
+    sent = {}
+    for micros, sender_id in positions:
+        if sender_id:
+            sent.setdefault(sender_id, []).append(micros)
+
+    for user_id in sorted(set(reads) | set(sent)):
+        own = sent.get(user_id, ())
+        read_at = reads.get(user_id)
+        if read_at is None:
+            unread = len(times) - len(own)
+        else:
+            read_micros = _micros(read_at)
+            unread = (
+                len(times) - bisect.bisect_right(times, read_micros)
+                - (len(own) - bisect.bisect_right(own, read_micros))
+            )
+        yield user_id, read_at, unread
+
+
+def iter_conversation_state(states, read_receipts):
+    """
+    Yield ("conversations", row) and ("participants", row) records in the
+    column order of the temporary tables.
+
+    `read_receipts` yields (conversation_id, user_id, last_read_at,
+    last_read_msg) sorted by conversation, as iter_read_receipts does; it is
+    merged with the message positions one conversation at a time.
+    """
+    latest = _iter_latest(states)
+    positions = _iter_positions(states)
+    reads = itertools.groupby(read_receipts, key=lambda receipt: receipt[0])
+
+    next_latest = next(latest, None)
+    next_positions = next(positions, None)
+    next_reads = next(reads, None)
+    while next_positions is not None or next_reads is not None:
+        if next_reads is None or (next_positions is not None and next_positions[0] <= next_reads[0]):
+            conversation_id = next_positions[0]
+        else:
+            conversation_id = next_reads[0]
+
+        conversation_positions = []
+        if next_positions is not None and next_positions[0] == conversation_id:
+            conversation_positions = next_positions[1]
+            next_positions = next(positions, None)
+        conversation_reads = {}
+        if next_reads is not None and next_reads[0] == conversation_id:
+            conversation_reads = {receipt[1]: receipt[2] for receipt in next_reads[1]}
+            next_reads = next(reads, None)
+
+        conversation_uuid = objectid_to_uuid(conversation_id)
+        while next_latest is not None and next_latest[0] < conversation_id:
+            next_latest = next(latest, None)
+        if next_latest is not None and next_latest[0] == conversation_id:
+            _, micros, sender_id, content = next_latest
+            yield "conversations", (
+                conversation_uuid, EPOCH + micros * ONE_MICROSECOND, content,
+                sender_id[:100] if sender_id is not None else None, len(conversation_positions),
+            )
+        for user_id, read_at, unread in participant_state(conversation_positions, conversation_reads):
+            yield "participants", (conversation_uuid, user_id[:100], read_at, unread)
+
+
+def _copy(cursor, table, columns, rows):
+    buffer = StringIO()
+    for row in rows:
+        buffer.write("\t".join(copy_text(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def write_conversation_state(pg_conn, states, read_receipts, copy_rows=COPY_ROWS):
+    """
+    Update messaging.conversations and messaging.participants from `states`
+    (ConversationState) and `read_receipts` in one transaction, with
+    triggers disabled so updated_at is left alone.
+
+    Returns (conversations updated, participants updated).
+    """
+    tables = {
+        "conversations": ("conversation_state", STATE_CONVERSATION_COLUMNS),
+        "participants": ("participant_state", STATE_PARTICIPANT_COLUMNS),
+    }
+    pending = {name: [] for name in tables}
+    staged = dict.fromkeys(tables, 0)
+    try:
+        with pg_conn.cursor() as cursor:
+            cursor.execute(DISABLE_TRIGGERS)
+            cursor.execute(CREATE_STATE_TABLES)
+            for name, row in iter_conversation_state(states, read_receipts):
+                rows = pending[name]
+                rows.append(row)
+                if len(rows) >= copy_rows:
+                    _copy(cursor, *tables[name], rows)
+                    staged[name] += len(rows)
+                    rows.clear()
+            for name, rows in pending.items():
+                if rows:
+                    _copy(cursor, *tables[name], rows)
+                    staged[name] += len(rows)
+            logger.info(
+                "Staged state of %d conversations and %d participants",
+                staged["conversations"], staged["participants"],
+            )
+
+            cursor.execute("ANALYZE conversation_state; ANALYZE participant_state")
+            cursor.execute(UPDATE_CONVERSATIONS)
+            conversations = cursor.rowcount
+            cursor.execute(UPDATE_PARTICIPANTS)
+            participants = cursor.rowcount
+            cursor.execute(UPDATE_SILENT_PARTICIPANTS)
+            participants += cursor.rowcount
+        pg_conn.commit()
+    except Exception:
+        pg_conn.rollback()
+        raise
+
+    logger.info(
+        "Updated %d conversations and %d participants from the message scan",
+        conversations, participants,
+    )
+    return conversations, participants
@@ -0,0 +1,179 @@
+"""
+Building blocks shared by the migration scripts.
+
+Holds what every migration needs the same way: the deterministic ObjectId ->
+UUID mapping (both targets must agree on it, so cross-references resolve),
+timestamp normalisation, the MongoDB and PostgreSQL connections, PostgreSQL
+session settings, progress logging and the registry of migrations
+(MIGRATIONS) that migrate_all.py runs side by side.
+"""
+
+import logging
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import psycopg2
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient
+
+# Stable namespace UUID for deterministic ObjectId -> UUID conversion.
+# Every migration uses it, so ids written to different targets line up.
+NAMESPACE_QUCKAPP = uuid.UUID("a1b2c3d4-e5f6-7890-abcd-ef1234567890")
+
+# Decode documents lazily: nested arrays stay as raw BSON until a row needs them.
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+READ_PREFERENCES = ("primary", "primaryPreferred", "secondary", "secondaryPreferred", "nearest")
+
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+logger = logging.getLogger(__name__)
+
+
+def configure_logging(fmt=LOG_FORMAT):
+    """Set up INFO logging to stderr, unless logging is configured already."""
+    logging.basicConfig(level=logging.INFO, format=fmt, datefmt=LOG_DATE_FORMAT)
+
+
+# ---------------------------------------------------------------------------
+# Value conversion
+# ---------------------------------------------------------------------------
+
+def objectid_to_uuid(oid):
+    """Convert a MongoDB ObjectId (or string) to a deterministic UUID v5."""
+    return uuid.uuid5(NAMESPACE_QUCKAPP, str(oid))
+
+
+def to_timestamp(value):
+    """Normalise a datetime-like value to a timezone-aware datetime or None."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value
+    return None
+
+
+# ---------------------------------------------------------------------------
+# MongoDB
+# ---------------------------------------------------------------------------
+
+def mongo_database(client, db_name=None):
+    """Database `db_name` of `client`, or the one named in its URI."""
+    return client[db_name] if db_name else client.get_default_database()
+
+
+def mongo_client(uri, read_preference=None, compressors=None):
+    """
+    Connect to MongoDB and return the client once the server answers.
+
+    `read_preference` and `compressors` override the URI options when set.
+    """
+    options = {}
+    if read_preference:
+        options["readPreference"] = read_preference
+    if compressors:
+        options["compressors"] = compressors
+    client = MongoClient(uri, **options)
+    # Verify connectivity.
+    client.admin.command("ping")
+    return client
+
+
+def connect_mongo(uri, db_name=None, read_preference=None, compressors=None):
+    """
+    Connect to MongoDB and return (client, database).
+
+    Without `db_name` the database named in `uri` is used.
+    """
+    client = mongo_client(uri, read_preference, compressors)
+    db = mongo_database(client, db_name)
+    logger.info("Connected to MongoDB database '%s'", db.name)
+    return client, db
+
+
+# ---------------------------------------------------------------------------
+# PostgreSQL
+# ---------------------------------------------------------------------------
+
+# messaging.conversations has a BEFORE UPDATE trigger that sets updated_at to
+# NOW(), which would replace the migrated value on every update. Run at the
+# start of a transaction, this turns off ordinary triggers until it ends,
+# foreign key checks and cascades included, so deletes must be explicit.
+# Needs superuser, or SET privilege on session_replication_role.
+DISABLE_TRIGGERS = "SET LOCAL session_replication_role = replica"
+
+
+def connect_postgres(uri):
+    """Connect to PostgreSQL and return the connection."""
+    conn = psycopg2.connect(uri)
+    conn.autocommit = False
+    logger.info("Connected to PostgreSQL at %s", uri.split("@")[-1] if "@" in uri else uri)
+    return conn
+
+
+# ---------------------------------------------------------------------------
+# Progress
+# ---------------------------------------------------------------------------
+
+class ProgressLog:
+    """
+    Logs a "Progress:" line every `every` documents of a scan.
+
+    `total` is the estimated number of documents (None when unknown) and
+    `start` the count a resumed scan starts from, which the rate excludes.
+    """
+
+    def __init__(self, noun, total=None, every=1000, start=0):
+        self.noun = noun
+        self.total = total
+        self.every = every
+        self.start = start
+        self._started = time.monotonic()
+
+    def update(self, done, detail=None):
+        """Report `done` documents; returns True when a line was logged."""
+        if done % self.every:
+            return False
+        rate = (done - self.start) / max(time.monotonic() - self._started, 1e-9)
+        count = f"{done} / ~{self.total}" if self.total is not None else f"{done}"
+        logger.info(
+            "Progress: %s %s migrated (%.0f/s)%s",
+            count, self.noun, rate, f", {detail}" if detail else "",
+        )
+        return True
+
+
+# ---------------------------------------------------------------------------
+# Migration registry
+# ---------------------------------------------------------------------------
+
+# One source collection mapped onto a target database. `module` is the
+# script implementing it; it must provide parse_args(argv) and
+# run(args, mongo_client=None), see migrate_all.py. `counts` names the
+# numbers run() returns, in order. Field-level mappings (map_conversation,
+# map_message) stay in those scripts, next to the statements they feed.
+Migration = namedtuple(
+    "Migration", ("name", "module", "source_db", "source", "target", "tables", "counts"),
+)
+
+MIGRATIONS = {
+    migration.name: migration
+    for migration in (
+        Migration(
+            "conversations", "migrate_conversations", "quckapp_gateway", "conversations", "postgres",
+            ("messaging.conversations", "messaging.participants"),
+            ("conversations", "participants"),
+        ),
+        Migration(
+            "messages", "migrate_messages", "quckapp", "messages", "scylla",
+            ("messages", "message_reactions", "read_receipts", "delivery_receipts", "messages_by_sender"),
+            ("messages",),
+        ),
+    )
+}
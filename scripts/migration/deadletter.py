@@ -0,0 +1,138 @@
+"""
+Retry policy and dead-letter files for failed writes.
+
+A write that still fails after its retries is appended, with the source
+`_id`s and the rows it carried, to a JSON-lines file in the dead-letter
+directory, and the migration carries on. Every process writes its own file,
+so shards never interleave records. `--replay-dead-letters` re-applies the
+records later; each replayed file is renamed to `*.replayed` and whatever
+fails again goes to a new file.
+"""
+
+import glob
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from bson import json_util
+from bson.binary import UuidRepresentation
+from bson.json_util import JSONMode, JSONOptions
+
+logger = logging.getLogger(__name__)
+
+# Attempts per write (the first try included) before it is dead-lettered.
+DEFAULT_WRITE_ATTEMPTS = 5
+
+# Backoff before retry n is uniform in [0, min(MAX_BACKOFF, BASE_BACKOFF * 2**n)].
+BASE_BACKOFF = 0.1
+MAX_BACKOFF = 10.0
+
+JSON_OPTIONS = JSONOptions(
+    json_mode=JSONMode.RELAXED,
+    uuid_representation=UuidRepresentation.STANDARD,
+    tz_aware=True,
+    tzinfo=timezone.utc,
+)
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff before retrying after `attempt` failures."""
+    return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+
+
+class DeadLetterWriter:
+    """Append-only JSON-lines file of writes that could not be applied."""
+
+    def __init__(self, directory, name):
+        self.path = os.path.join(directory, f"{name}.jsonl")
+        self.directory = directory
+        self.count = 0
+        self._lock = threading.Lock()
+        self._fh = None
+
+    def write(self, target, table, rows, source_ids, error, attempts, **extra):
+        """
+        Record one failed write; returns once the record is on disk.
+
+        `extra` holds whatever else the target needs to replay the rows.
+        """
+        record = {
+            "target": target,
+            "table": table,
+            "source_ids": [str(source_id) for source_id in source_ids if source_id is not None],
+            "rows": rows,
+            **extra,
+            "error": f"{type(error).__name__}: {error}",
+            "attempts": attempts,
+            "failed_at": datetime.now(timezone.utc),
+        }
+        line = json_util.dumps(record, json_options=JSON_OPTIONS)
+        with self._lock:
+            if self._fh is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._fh = open(self.path, "a", encoding="utf-8")
+            self._fh.write(line + "\n")
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self.count += 1
+        logger.warning(
+            "Dead-lettered %d %s rows after %d attempts (%s) to %s",
+            len(rows), table, attempts, record["error"], self.path,
+        )
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+def pending_dead_letter_files(directory):
+    """Dead-letter files in `directory` that have not been replayed yet."""
+    return sorted(glob.glob(os.path.join(directory, "*.jsonl")))
+
+
+def read_dead_letters(path):
+    """Yield the records of one dead-letter file."""
+    with open(path, "r", encoding="utf-8") as fh:
+        for line in fh:
+            if line.strip():
+                yield json_util.loads(line, json_options=JSON_OPTIONS)
+
+
+def replay_dead_letters(directory, name, replay_file):
+    """
+    Re-apply every pending dead-letter file in `directory`.
+
+    `replay_file(records, dead_letters)` must write the records of one file,
+    sending those that fail again to `dead_letters`, and return how many it
+    read. Returns (records replayed, records failed again).
+    """
+    files = pending_dead_letter_files(directory)
+    if not files:
+        logger.info("No dead letters to replay in %s", directory)
+        return 0, 0
+
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    dead_letters = DeadLetterWriter(directory, f"{name}-replay-{stamp}")
+    replayed = 0
+    try:
+        for path in files:
+            records = replay_file(read_dead_letters(path), dead_letters)
+            os.replace(path, f"{path}.replayed")
+            replayed += records
+            logger.info("Replayed %d dead-letter records from %s", records, path)
+    finally:
+        dead_letters.close()
+
+    if dead_letters.count:
+        logger.warning("%d records failed again; see %s", dead_letters.count, dead_letters.path)
+    return replayed, dead_letters.count
+
+
+def wait_before_retry(attempt):
+    """Sleep for the backoff of `attempt` failures (synchronous callers)."""
+    time.sleep(backoff_delay(attempt))
@@ -0,0 +1,166 @@
+"""
+Rows held back from the main scan and written in a second, sorted pass,
+used by migrate_messages.py (--sender-second-pass).
+
+The `_id`-ordered scan produces the rows of secondary tables such as
+messages_by_sender in random partition order. A DeferredRows store keeps
+them instead: rows are buffered in memory and, once the buffer exceeds its
+budget, sorted and written to disk as a run. `items()` merges all runs with
+the buffer and yields every row sorted by (table, row), which for tables
+whose columns start with the primary key is partition and clustering order.
+"""
+
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+
+# Default in-memory budget before the buffer spills to disk.
+DEFAULT_SPILL_MEMORY_MB = 256
+
+# Approximate cost of one buffered row on top of its text values: the row
+# and record tuples, its UUID and datetime objects and the list slot.
+ROW_BYTES = 400
+
+# Rows pickled together in one frame of a run file.
+FRAME_ROWS = 1000
+
+# Runs merged at once; more runs are first merged into larger ones, so the
+# final merge never holds more than this many files open.
+MERGE_FAN_IN = 128
+
+
+def sort_key(record):
+    """Order of a (table, row) record; None sorts before any other value."""
+    table, row = record
+    return table, tuple((value is not None, value) for value in row)
+
+
+def _write_run(path, records):
+    with open(path, "wb") as fh:
+        frame = []
+        for record in records:
+            frame.append(record)
+            if len(frame) >= FRAME_ROWS:
+                pickle.dump(frame, fh, protocol=pickle.HIGHEST_PROTOCOL)
+                frame = []
+        if frame:
+            pickle.dump(frame, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def _read_run(path):
+    with open(path, "rb") as fh:
+        while True:
+            try:
+                frame = pickle.load(fh)
+            except EOFError:
+                return
+            yield from frame
+
+
+def _merge_runs(paths, directory, fan_in):
+    """Merge runs `fan_in` at a time into `directory` until at most `fan_in` remain."""
+    level = 0
+    while len(paths) > fan_in:
+        merged = []
+        for start in range(0, len(paths), fan_in):
+            group = paths[start:start + fan_in]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            path = os.path.join(directory, f"merge-{level:02d}-{len(merged):05d}.pickle")
+            _write_run(path, heapq.merge(*(_read_run(run) for run in group), key=sort_key))
+            merged.append(path)
+            # Intermediate runs are ours; the stores' own runs stay in place.
+            for run in group:
+                if os.path.dirname(run) == directory:
+                    os.remove(run)
+        paths = merged
+        level += 1
+    return paths
+
+
+def iter_deferred_rows(stores):
+    """
+    Yield (table, row) across several stores, sorted by sort_key.
+
+    With more than MERGE_FAN_IN runs in total, runs are merged in several
+    passes through a temporary directory next to the first store's runs.
+    """
+    runs = [path for store in stores for path in store._runs]
+    memory = [store._sorted_memory() for store in stores if store._rows]
+    merge_dir = None
+    try:
+        if len(runs) + len(memory) > MERGE_FAN_IN:
+            spill_dir = next((store.spill_dir for store in stores if store._runs), None)
+            merge_dir = tempfile.mkdtemp(prefix="merge-", dir=spill_dir)
+            runs = _merge_runs(runs, merge_dir, max(2, MERGE_FAN_IN - len(memory)))
+        streams = [_read_run(path) for path in runs] + [iter(rows) for rows in memory]
+        yield from heapq.merge(*streams, key=sort_key)
+    finally:
+        if merge_dir is not None:
+            shutil.rmtree(merge_dir, ignore_errors=True)
+
+
+class DeferredRows:
+    """
+    (table, row) records to be written after the scan, in sorted order.
+
+    The buffer is bounded by ``memory_mb``; runs are written under
+    ``spill_dir`` (a private temporary directory when none is given). Stores
+    are picklable, so they can be checkpointed or returned from worker
+    processes as long as the spill directory stays in place.
+    """
+
+    def __init__(self, spill_dir=None, memory_mb=DEFAULT_SPILL_MEMORY_MB):
+        self.spill_dir = spill_dir
+        self.max_bytes = max(1, memory_mb) * 1024 * 1024
+        self.spilled = 0
+        self._owns_spill_dir = False
+        self._rows = []
+        self._bytes = 0
+        self._runs = []
+
+    def __len__(self):
+        return len(self._rows) + self.spilled
+
+    def add(self, table, row):
+        """Hold back `row` of `table` until the second pass."""
+        self._rows.append((table, row))
+        self._bytes += ROW_BYTES + sum(len(value) for value in row if isinstance(value, str))
+        if self._bytes >= self.max_bytes:
+            self.spill()
+
+    def spill(self):
+        """Write the buffer to a sorted run file and clear it."""
+        if not self._rows:
+            return
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="deferred-rows-")
+            self._owns_spill_dir = True
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        # Runs are numbered, so a store restored from an older checkpoint
+        # simply overwrites the runs written after that checkpoint.
+        path = os.path.join(self.spill_dir, f"run-{len(self._runs):05d}.pickle")
+        _write_run(path, self._sorted_memory())
+
+        self._runs.append(path)
+        self.spilled += len(self._rows)
+        self._rows = []
+        self._bytes = 0
+
+    def items(self):
+        """Yield every (table, row), sorted by sort_key."""
+        return iter_deferred_rows([self])
+
+    def cleanup(self):
+        """Remove spill files if the store created its own directory."""
+        if self._owns_spill_dir and self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def _sorted_memory(self):
+        return sorted(self._rows, key=sort_key)
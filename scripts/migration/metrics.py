@@ -0,0 +1,313 @@
+"""
+Prometheus metrics for the migration scripts.
+
+Metrics live in process memory and are served in the Prometheus text
+exposition format by `start_metrics_server` (--metrics-port). Worker
+processes (--workers) cannot share memory with the parent, so each one
+periodically writes a snapshot of its metrics into a directory that the
+parent adds to its own values on every scrape.
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two snapshots written by a worker process.
+SNAPSHOT_INTERVAL = 5
+
+# Request latency buckets in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+_snapshot_dir = None
+_started = time.time()
+
+
+class _Child:
+    """A metric bound to one set of label values."""
+
+    def __init__(self, metric, key):
+        self._metric = metric
+        self._key = key
+
+    def inc(self, amount=1):
+        self._metric._add(self._key, amount)
+
+    def dec(self, amount=1):
+        self._metric._add(self._key, -amount)
+
+    def set(self, value):
+        self._metric._set(self._key, value)
+
+    def observe(self, value):
+        self._metric._observe(self._key, value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        return _Child(self, tuple(str(value) for value in values))
+
+    def inc(self, amount=1):
+        self._add((), amount)
+
+    def dec(self, amount=1):
+        self._add((), -amount)
+
+    def set(self, value):
+        self._set((), value)
+
+    def observe(self, value):
+        self._observe((), value)
+
+    def _add(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def _observe(self, key, value):
+        raise TypeError(f"{self.kind} {self.name} cannot observe values")
+
+    def value(self, *labels):
+        """Current value in this process (tests and log lines)."""
+        return self._values.get(tuple(str(label) for label in labels), 0)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def merge(total, value):
+        return total + value
+
+    def samples(self, key, value):
+        yield self.name, key, value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+
+class Gauge(_Metric):
+    """Gauge; values from several processes are added up."""
+
+    kind = "gauge"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _add(self, key, amount):
+        raise TypeError(f"histogram {self.name} only supports observe()")
+
+    def _set(self, key, value):
+        raise TypeError(f"histogram {self.name} only supports observe()")
+
+    def _observe(self, key, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, +Inf last, then sum.
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(value)] for key, value in self._values.items()]
+
+    @staticmethod
+    def merge(total, value):
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self, key, value):
+        counts, total = value[:-1], value[-1]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f"{self.name}_bucket", key + (("le", le),), cumulative
+        yield f"{self.name}_sum", key, total
+        yield f"{self.name}_count", key, cumulative
+
+
+# ---------------------------------------------------------------------------
+# Migration metrics
+# ---------------------------------------------------------------------------
+
+DOCS_READ = Counter(
+    "migration_docs_read_total", "Source documents read from MongoDB", ("collection",),
+)
+DOCS_ESTIMATED = Gauge(
+    "migration_docs_estimated", "Estimated number of source documents", ("collection",),
+)
+ROWS_WRITTEN = Counter(
+    "migration_rows_written_total", "Rows acknowledged by the target database", ("table",),
+)
+WRITE_SECONDS = Histogram(
+    "migration_write_duration_seconds", "Latency of one write request or batch", ("target", "request"),
+)
+WRITE_ERRORS = Counter(
+    "migration_write_errors_total", "Failed write requests", ("target",),
+)
+RETRIES = Counter(
+    "migration_retries_total", "Requests retried after a failure", ("target",),
+)
+IN_FLIGHT = Gauge(
+    "migration_in_flight_requests", "Write requests awaiting a response", ("target",),
+)
+CONCURRENCY_LIMIT = Gauge(
+    "migration_concurrency_limit", "Current limit on in-flight write requests", ("target",),
+)
+BATCH_SCALE = Gauge(
+    "migration_batch_scale", "Current fraction of the configured batch size", ("target",),
+)
+RATE_LIMIT = Gauge(
+    "migration_rate_limit_rows_per_second", "Rows/s ceiling (0 for unlimited)", ("target",),
+)
+CONNECTION_ROWS = Counter(
+    "migration_connection_rows_total", "Rows committed per pooled database connection",
+    ("target", "connection"),
+)
+TRACKER_ENTRIES = Gauge(
+    "migration_read_receipt_tracker_entries", "Keys held by the read receipt tracker", (),
+)
+
+
+def _escape(text, quote=True):
+    """Escape text for the Prometheus text format: `\\`, newline and, in label values, `"`."""
+    text = str(text).replace("\\", "\\\\").replace("\n", "\\n")
+    return text.replace('"', '\\"') if quote else text
+
+
+def _label_text(key):
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in key)
+
+
+def _merged(metric, snapshots):
+    values = {key: value for key, value in ((tuple(k), v) for k, v in metric.snapshot())}
+    for snapshot in snapshots:
+        for key, value in snapshot.get(metric.name, []):
+            key = tuple(key)
+            values[key] = metric.merge(values[key], value) if key in values else value
+    return values
+
+
+def _eta_lines(merged):
+    read = merged.get(DOCS_READ.name, {})
+    estimated = merged.get(DOCS_ESTIMATED.name, {})
+    elapsed = time.time() - _started
+    lines = [
+        "# HELP migration_eta_seconds Estimated seconds until all documents are read",
+        "# TYPE migration_eta_seconds gauge",
+    ]
+    for key, total in estimated.items():
+        done = read.get(key, 0)
+        if done <= 0 or elapsed <= 0:
+            continue
+        eta = max(0.0, (total - done) / (done / elapsed))
+        lines.append(f"migration_eta_seconds{{{_label_text(zip(DOCS_READ.labelnames, key))}}} {eta:.1f}")
+    return lines
+
+
+def render():
+    """Return all metrics, including worker snapshots, in text format."""
+    snapshots = []
+    if _snapshot_dir is not None:
+        for name in sorted(os.listdir(_snapshot_dir)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(_snapshot_dir, name), "r", encoding="utf-8") as fh:
+                    snapshots.append(json.load(fh))
+            except (OSError, ValueError):
+                continue  # Being replaced right now; picked up next scrape.
+
+    lines = []
+    merged = {}
+    for metric in REGISTRY:
+        values = merged[metric.name] = _merged(metric, snapshots)
+        lines.append(f"# HELP {metric.name} {_escape(metric.documentation, quote=False)}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key, value in sorted(values.items()):
+            labels = tuple(zip(metric.labelnames, key))
+            for sample, sample_labels, sample_value in metric.samples(labels, value):
+                text = _label_text(sample_labels)
+                lines.append(f"{sample}{{{text}}} {sample_value}" if text else f"{sample} {sample_value}")
+    lines.extend(_eta_lines(merged))
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format, *args)
+
+
+def start_metrics_server(port, snapshot_dir=None):
+    """
+    Serve /metrics on `port` from a daemon thread.
+
+    Snapshots written by worker processes into `snapshot_dir` are included.
+    """
+    global _snapshot_dir
+    _snapshot_dir = snapshot_dir
+    if snapshot_dir is not None:
+        os.makedirs(snapshot_dir, exist_ok=True)
+    server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on :%d/metrics", port)
+    return server
+
+
+def write_snapshot(directory, name):
+    """Write this process's metrics to `directory` for the parent to serve."""
+    payload = json.dumps({metric.name: metric.snapshot() for metric in REGISTRY})
+    path = os.path.join(directory, f"{name}.json")
+    with open(f"{path}.tmp", "w", encoding="utf-8") as fh:
+        fh.write(payload)
+    os.replace(f"{path}.tmp", path)
+
+
+def start_snapshot_writer(directory, name, interval=SNAPSHOT_INTERVAL):
+    """Write snapshots from a daemon thread every `interval` seconds."""
+    def run():
+        while True:
+            time.sleep(interval)
+            write_snapshot(directory, name)
+
+    threading.Thread(target=run, name="metrics-snapshot", daemon=True).start()
@@ -0,0 +1,150 @@
+"""
+Staged reader -> transform -> writer pipeline over a MongoDB cursor.
+
+A reader thread cuts the cursor into chunks of raw BSON documents and submits
+each chunk to a pool of transform processes. The pending results travel
+through a bounded queue in cursor order, so:
+
+  - the reader stops fetching once `depth` chunks are waiting (backpressure),
+  - transforms of several chunks run in parallel on separate cores,
+  - the writer (whoever iterates the pipeline) sees results in `_id` order,
+    which keeps checkpoints a contiguous prefix of the scan.
+"""
+
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from checkpoint import raise_if_stopped
+
+logger = logging.getLogger(__name__)
+
+# Number of transformed chunks allowed to wait for the writer.
+DEFAULT_PIPELINE_DEPTH = 8
+
+_DONE = object()
+
+
+class StageStats:
+    """Item counter with throughput since the stage started."""
+
+    def __init__(self):
+        self.count = 0
+        self.started = time.monotonic()
+
+    def add(self, count):
+        self.count += count
+
+    @property
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+
+class TransformPipeline:
+    """
+    Iterate `transform(raw_docs)` results for every chunk of `cursor`.
+
+    `transform` must be a picklable top-level function taking a list of raw
+    BSON bytes and returning a list of results; the iterator yields those
+    results one by one. Use as a context manager so the reader thread and
+    the process pool are always shut down. Raises KeyboardInterrupt once
+    checkpoint.request_stop has been called.
+    """
+
+    def __init__(self, cursor, transform, workers, chunk_size,
+                 depth=DEFAULT_PIPELINE_DEPTH):
+        self.cursor = cursor
+        self.transform = transform
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.depth = depth
+        self.read = StageStats()
+        self.transformed = StageStats()
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._pool = None
+        self._reader = None
+
+    def __enter__(self):
+        context = multiprocessing.get_context("spawn")
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        self._reader = threading.Thread(target=self._read, name="pipeline-reader", daemon=True)
+        self._reader.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        # Unblock a reader waiting on a full queue.
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if hasattr(item, "cancel"):
+                item.cancel()
+        self._reader.join()
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        return False
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            raise_if_stopped()
+            try:
+                results = item.result()
+            except BrokenProcessPool:
+                # checkpoint.request_stop terminates the transform workers too;
+                # surface that as the interrupt it is, so the scan checkpoints.
+                raise_if_stopped()
+                raise
+            self.transformed.add(len(results))
+            yield from results
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def describe(self):
+        """One-line summary of per-stage throughput and queue depth."""
+        return (
+            f"read {self.read.count} ({self.read.rate:.0f}/s), "
+            f"transformed {self.transformed.count} ({self.transformed.rate:.0f}/s), "
+            f"queue {self.queue_depth}/{self.depth}"
+        )
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _submit(self, chunk):
+        self.read.add(len(chunk))
+        return self._put(self._pool.submit(self.transform, chunk))
+
+    def _read(self):
+        try:
+            chunk = []
+            for doc in self.cursor:
+                chunk.append(doc.raw)
+                if len(chunk) >= self.chunk_size:
+                    if not self._submit(chunk):
+                        return
+                    chunk = []
+            if chunk and not self._submit(chunk):
+                return
+            self._put(_DONE)
+        except BaseException as exc:  # Re-raised in the writer thread.
+            self._put(exc)
@@ -0,0 +1,371 @@
+"""
+Per-run profiling report for the migration scripts (--profile).
+
+`enable` wraps hot-path functions and methods (BSON decoding, id mapping,
+statement binding, waiting on the write window, ...) with timers that add
+up calls and seconds per stage. Nothing is wrapped unless profiling is on,
+so a normal run executes the original functions. Timings are kept per
+thread and merged when the report is written; stages nest, so a stage's
+seconds include those of the stages it calls.
+
+Besides the timers, a profiled run records write latencies in a bounded
+reservoir sample (record_latency) and can open a window of
+`window` seconds, `window_start` seconds into the run, during which
+cProfile runs on the writer thread and tracemalloc traces allocations;
+the allocation sites of the largest traced snapshot are reported.
+
+Worker processes write their share with `write_part`; `write_report` merges
+those parts with the parent's own figures into one JSON file. Keys are
+sorted and values rounded, so reports of two runs can be compared with diff.
+"""
+
+import cProfile
+import functools
+import glob
+import json
+import logging
+import os
+import pstats
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+from metrics import ROWS_WRITTEN
+
+logger = logging.getLogger(__name__)
+
+# Latencies kept per request kind; later ones replace random earlier ones.
+LATENCY_SAMPLES = 100_000
+
+# Functions (cProfile) and allocation sites (tracemalloc) in the report.
+TOP_ENTRIES = 25
+
+# A new tracemalloc snapshot is taken once traced memory grows by this factor.
+SNAPSHOT_GROWTH = 1.1
+
+_lock = threading.Lock()
+_local = threading.local()
+_enabled = False
+_started = None
+_installed = []
+_thread_timers = []
+_latencies = {}
+_latency_counts = {}
+_window = None
+
+
+# ---------------------------------------------------------------------------
+# Stage timers
+# ---------------------------------------------------------------------------
+
+def _timers():
+    timers = getattr(_local, "timers", None)
+    if timers is None:
+        timers = _local.timers = {}
+        with _lock:
+            _thread_timers.append(timers)
+    return timers
+
+
+def timed(stage, func):
+    """Wrap `func` so every call adds to the calls and seconds of `stage`."""
+    perf_counter = time.perf_counter
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timers = _timers()
+            timer = timers.get(stage)
+            if timer is None:
+                timer = timers[stage] = [0, 0.0]
+            timer[0] += 1
+            timer[1] += perf_counter() - started
+
+    return wrapper
+
+
+def _install(owner, name, stage):
+    # Look static methods up in the class dict so they stay static.
+    original = owner.__dict__[name] if isinstance(owner, type) else getattr(owner, name)
+    if isinstance(original, staticmethod):
+        replacement = staticmethod(timed(stage, original.__func__))
+    else:
+        replacement = timed(stage, original)
+    setattr(owner, name, replacement)
+    _installed.append((owner, name, original))
+
+
+def enable(targets, window_start=0.0, window=0.0):
+    """
+    Start profiling this process.
+
+    `targets` are (owner, attribute, stage) triples: every function or
+    method `owner.attribute` is timed as `stage`. With `window` > 0 the
+    cProfile/tracemalloc window opens at the first poll() `window_start`
+    seconds from now.
+    """
+    global _enabled, _started, _window
+    if _enabled:
+        return
+    for owner, name, stage in targets:
+        _install(owner, name, stage)
+    _enabled = True
+    _started = time.monotonic()
+    _window = _Window(_started + window_start, window) if window > 0 else None
+
+
+def disable():
+    """Close the window and restore every wrapped function."""
+    global _enabled
+    if _window is not None:
+        _window.close()
+    while _installed:
+        owner, name, original = _installed.pop()
+        setattr(owner, name, original)
+    _enabled = False
+
+
+def record_latency(kind, seconds):
+    """Keep the latency of one write request of `kind` in the sample."""
+    if not _enabled:
+        return
+    with _lock:
+        count = _latency_counts[kind] = _latency_counts.get(kind, 0) + 1
+        sample = _latencies.setdefault(kind, [])
+        if len(sample) < LATENCY_SAMPLES:
+            sample.append(seconds)
+        else:
+            slot = random.randrange(count)
+            if slot < LATENCY_SAMPLES:
+                sample[slot] = seconds
+
+
+def poll():
+    """Open or close the profiling window when due; call from the writer thread."""
+    if _window is not None:
+        _window.poll()
+
+
+# ---------------------------------------------------------------------------
+# cProfile / tracemalloc window
+# ---------------------------------------------------------------------------
+
+def _function_name(key):
+    filename, line, function = key
+    return f"{os.path.basename(filename)}:{line}({function})"
+
+
+class _Window:
+    """cProfile on the polling thread plus tracemalloc, for a fixed time."""
+
+    def __init__(self, opens_at, duration):
+        self.opens_at = opens_at
+        self.duration = duration
+        self.profiler = None
+        self.closes_at = None
+        self.closed = False
+        self.functions = {}
+        self.sites = {}
+        self.traced_peak = 0
+        self._snapshot_size = 0
+        self._snapshot = None
+
+    def poll(self):
+        if self.closed:
+            return
+        now = time.monotonic()
+        if self.profiler is None:
+            if now >= self.opens_at:
+                logger.info("Profiling window open for %.0fs (cProfile, tracemalloc)", self.duration)
+                tracemalloc.start()
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+                self.closes_at = now + self.duration
+            return
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self._snapshot_size * SNAPSHOT_GROWTH:
+            self._snapshot = tracemalloc.take_snapshot()
+            self._snapshot_size = current
+        if now >= self.closes_at:
+            self.close()
+
+    def close(self):
+        if self.closed or self.profiler is None:
+            return
+        self.profiler.disable()
+        self.closed = True
+        if self._snapshot is None:
+            self._snapshot = tracemalloc.take_snapshot()
+        self.traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        stats = pstats.Stats(self.profiler).stats
+        for key, (_, calls, tottime, cumtime, _) in stats.items():
+            self.functions[_function_name(key)] = [calls, tottime, cumtime]
+        # Leave out what tracemalloc and the timers allocate themselves.
+        snapshot = self._snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+        for statistic in snapshot.statistics("lineno"):
+            frame = statistic.traceback[0]
+            site = f"{os.path.basename(frame.filename)}:{frame.lineno}"
+            size, count = self.sites.get(site, (0, 0))
+            self.sites[site] = (size + statistic.size, count + statistic.count)
+        self._snapshot = None
+        logger.info("Profiling window closed")
+
+
+# ---------------------------------------------------------------------------
+# Reports
+# ---------------------------------------------------------------------------
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and in bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _part():
+    """This process's figures, in the format of the part files."""
+    if _window is not None:
+        _window.close()
+    stages = {}
+    with _lock:
+        for timers in _thread_timers:
+            for stage, (calls, seconds) in list(timers.items()):
+                total = stages.setdefault(stage, [0, 0.0])
+                total[0] += calls
+                total[1] += seconds
+        latencies = {kind: list(sample) for kind, sample in _latencies.items()}
+        latency_counts = dict(_latency_counts)
+    window = _window
+    return {
+        "stages": stages,
+        "rows": {key[0]: value for key, value in ROWS_WRITTEN.snapshot()},
+        "latencies": latencies,
+        "latency_counts": latency_counts,
+        "peak_rss_mb": peak_rss_mb(),
+        "window": window is not None and window.closed,
+        "traced_peak": window.traced_peak if window is not None else 0,
+        "functions": window.functions if window is not None else {},
+        "sites": {site: list(value) for site, value in (window.sites if window is not None else {}).items()},
+    }
+
+
+def write_part(directory, name):
+    """Write this process's figures to `directory` for the parent's report."""
+    path = os.path.join(directory, f"{name}.json")
+    with open(f"{path}.tmp", "w", encoding="utf-8") as fh:
+        json.dump(_part(), fh)
+    os.replace(f"{path}.tmp", path)
+
+
+def _merge(parts):
+    merged = {
+        "stages": {}, "rows": {}, "latencies": {}, "latency_counts": {},
+        "peak_rss_mb": 0.0, "window": False, "traced_peak": 0, "functions": {}, "sites": {},
+    }
+    for part in parts:
+        for stage, (calls, seconds) in part["stages"].items():
+            total = merged["stages"].setdefault(stage, [0, 0.0])
+            total[0] += calls
+            total[1] += seconds
+        for table, rows in part["rows"].items():
+            merged["rows"][table] = merged["rows"].get(table, 0) + rows
+        for kind, sample in part["latencies"].items():
+            merged["latencies"].setdefault(kind, []).extend(sample)
+        for kind, count in part["latency_counts"].items():
+            merged["latency_counts"][kind] = merged["latency_counts"].get(kind, 0) + count
+        merged["peak_rss_mb"] = max(merged["peak_rss_mb"], part["peak_rss_mb"])
+        merged["window"] = merged["window"] or part["window"]
+        merged["traced_peak"] += part["traced_peak"]
+        for function, values in part["functions"].items():
+            total = merged["functions"].setdefault(function, [0, 0.0, 0.0])
+            merged["functions"][function] = [a + b for a, b in zip(total, values)]
+        for site, values in part["sites"].items():
+            total = merged["sites"].setdefault(site, [0, 0])
+            merged["sites"][site] = [a + b for a, b in zip(total, values)]
+    return merged
+
+
+def _percentiles(sample):
+    ordered = sorted(sample)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 3)
+
+    return {"p50_ms": at(0.5), "p90_ms": at(0.9), "p99_ms": at(0.99), "max_ms": round(ordered[-1] * 1000, 3)}
+
+
+def _top(entries, key):
+    # Ties are broken by name so equal runs list entries in the same order.
+    return sorted(entries.items(), key=lambda item: (-key(item[1]), item[0]))[:TOP_ENTRIES]
+
+
+def write_report(path, parts_dir=None, settings=None):
+    """
+    Merge this process's figures with the parts in `parts_dir` and write
+    the JSON report to `path`; returns the report.
+    """
+    parts = [_part()]
+    for part_path in sorted(glob.glob(os.path.join(parts_dir, "*.json"))) if parts_dir else []:
+        with open(part_path, "r", encoding="utf-8") as fh:
+            parts.append(json.load(fh))
+    merged = _merge(parts)
+    elapsed = time.monotonic() - _started if _started is not None else 0.0
+
+    report = {
+        "run": {
+            "elapsed_seconds": round(elapsed, 3),
+            "processes": len(parts),
+            "settings": settings or {},
+        },
+        "stages": {
+            stage: {
+                "calls": calls,
+                "seconds": round(seconds, 3),
+                "mean_us": round(seconds / calls * 1e6, 2) if calls else 0.0,
+                "share_of_elapsed": round(seconds / elapsed, 4) if elapsed > 0 else 0.0,
+            }
+            for stage, (calls, seconds) in merged["stages"].items()
+        },
+        "tables": {
+            table: {"rows": rows, "rows_per_second": round(rows / elapsed, 1) if elapsed > 0 else 0.0}
+            for table, rows in merged["rows"].items()
+        },
+        "write_latency": {
+            kind: {"requests": merged["latency_counts"][kind], "sampled": len(sample), **_percentiles(sample)}
+            for kind, sample in merged["latencies"].items() if sample
+        },
+        "memory": {
+            "peak_rss_mb": round(merged["peak_rss_mb"], 1),
+            "traced_peak_mb": round(merged["traced_peak"] / (1024 * 1024), 1),
+            "sites": [
+                {"site": site, "size_mb": round(size / (1024 * 1024), 3), "blocks": count}
+                for site, (size, count) in _top(merged["sites"], key=lambda value: value[0])
+            ],
+        },
+        "functions": [
+            {
+                "function": function,
+                "calls": calls,
+                "self_seconds": round(tottime, 3),
+                "cumulative_seconds": round(cumtime, 3),
+            }
+            for function, (calls, tottime, cumtime) in _top(merged["functions"], key=lambda value: value[1])
+        ],
+        "window": merged["window"],
+    }
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
+        fh.write("\n")
+    logger.info("Wrote profiling report to %s", path)
+    return report
@@ -0,0 +1,244 @@
+"""
+Memory-bounded aggregation of the latest read position per
+(conversation_id, user_id), used by migrate_messages.py.
+
+Ids are interned to integers and each position is packed into 24 bytes
+(epoch micros + message UUID) instead of a tuple of Python objects. Once the
+in-memory table exceeds its budget it is written to disk as a run sorted by
+(conversation_id, user_id); `items()` merges all runs with the in-memory
+table and yields the latest read per key in sorted order. As in deferred.py,
+no more than MERGE_FAN_IN runs are open at once: more runs are first merged
+into larger ones.
+"""
+
+import heapq
+import os
+import shutil
+import struct
+import tempfile
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from deferred import MERGE_FAN_IN
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+# Default in-memory budget before the table spills to disk.
+DEFAULT_MEMORY_MB = 256
+
+# Approximate cost of one in-memory entry: int key, 24-byte packed value and
+# the dict slot holding them.
+ENTRY_BYTES = 160
+
+_VALUE = struct.Struct(">q16s")
+_RECORD_HEADER = struct.Struct(">HH")
+
+
+def _micros(value):
+    return int.from_bytes(value[:8], "big", signed=True)
+
+
+def _decode(record):
+    conversation_id, user_id, value = record
+    micros, message_id = _VALUE.unpack(value)
+    return (
+        conversation_id,
+        user_id,
+        EPOCH + timedelta(microseconds=micros),
+        uuid.UUID(bytes=message_id),
+    )
+
+
+def _read_run(path):
+    with open(path, "rb") as fh:
+        while True:
+            header = fh.read(_RECORD_HEADER.size)
+            if not header:
+                return
+            conv_len, user_len = _RECORD_HEADER.unpack(header)
+            body = fh.read(conv_len + user_len + _VALUE.size)
+            yield (
+                body[:conv_len].decode("utf-8"),
+                body[conv_len:conv_len + user_len].decode("utf-8"),
+                body[conv_len + user_len:],
+            )
+
+
+def _write_run(path, records):
+    with open(path, "wb") as fh:
+        for conversation_id, user_id, value in records:
+            conv_bytes = conversation_id.encode("utf-8")
+            user_bytes = user_id.encode("utf-8")
+            fh.write(_RECORD_HEADER.pack(len(conv_bytes), len(user_bytes)))
+            fh.write(conv_bytes)
+            fh.write(user_bytes)
+            fh.write(value)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def _latest(streams):
+    """Merge sorted record streams, keeping the latest read per key."""
+    current = None
+    for record in heapq.merge(*streams, key=lambda r: (r[0], r[1])):
+        if current is not None and current[0] == record[0] and current[1] == record[1]:
+            # Strictly later wins, so ties keep the first record seen.
+            if _micros(record[2]) > _micros(current[2]):
+                current = record
+            continue
+        if current is not None:
+            yield current
+        current = record
+    if current is not None:
+        yield current
+
+
+def _merge_runs(paths, directory, fan_in):
+    """Merge runs `fan_in` at a time into `directory` until at most `fan_in` remain."""
+    level = 0
+    while len(paths) > fan_in:
+        merged = []
+        for start in range(0, len(paths), fan_in):
+            group = paths[start:start + fan_in]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            # Groups are consecutive, so ties still keep the record of the earlier run.
+            path = os.path.join(directory, f"merge-{level:02d}-{len(merged):05d}.bin")
+            _write_run(path, _latest([_read_run(run) for run in group]))
+            merged.append(path)
+            # Intermediate runs are ours; the stores' own runs stay in place.
+            for run in group:
+                if os.path.dirname(run) == directory:
+                    os.remove(run)
+        paths = merged
+        level += 1
+    return paths
+
+
+def iter_read_receipts(stores):
+    """
+    Yield (conversation_id, user_id, last_read_at, last_read_msg) across
+    several stores, sorted by conversation_id and user_id.
+
+    Stores are merged in the order given, which only matters for ties. With
+    more than MERGE_FAN_IN runs in total, runs are merged in several passes
+    through a temporary directory next to the first store's runs.
+    """
+    merge_dir = None
+    try:
+        if sum(len(store._runs) + bool(store._entries) for store in stores) > MERGE_FAN_IN:
+            spill_dir = next((store.spill_dir for store in stores if store._runs), None)
+            merge_dir = tempfile.mkdtemp(prefix="merge-", dir=spill_dir)
+            # In-memory tables become runs too, keeping every store's records in order.
+            runs = []
+            for index, store in enumerate(stores):
+                runs.extend(store._runs)
+                if store._entries:
+                    path = os.path.join(merge_dir, f"memory-{index:05d}.bin")
+                    _write_run(path, store._sorted_memory())
+                    runs.append(path)
+            streams = [_read_run(path) for path in _merge_runs(runs, merge_dir, MERGE_FAN_IN)]
+        else:
+            streams = [stream for store in stores for stream in store._sorted_records()]
+        for record in _latest(streams):
+            yield _decode(record)
+    finally:
+        if merge_dir is not None:
+            shutil.rmtree(merge_dir, ignore_errors=True)
+
+
+class ReadReceiptStore:
+    """
+    Latest (read_at, message_id) per (conversation_id, user_id).
+
+    ``max_entries`` bounds the in-memory table; runs are written under
+    ``spill_dir`` (a private temporary directory when none is given). Stores
+    are picklable, so they can be checkpointed or returned from worker
+    processes as long as the spill directory stays in place.
+    """
+
+    def __init__(self, spill_dir=None, memory_mb=DEFAULT_MEMORY_MB):
+        self.spill_dir = spill_dir
+        self.max_entries = max(1, memory_mb * 1024 * 1024 // ENTRY_BYTES)
+        self.spilled = 0
+        self._owns_spill_dir = False
+        self._conversation_index = {}
+        self._conversations = []
+        self._user_index = {}
+        self._users = []
+        self._entries = {}
+        self._runs = []
+
+    def __len__(self):
+        """Upper bound on the number of keys (spilled duplicates included)."""
+        return len(self._entries) + self.spilled
+
+    @staticmethod
+    def _intern(value, index, values):
+        key = index.get(value)
+        if key is None:
+            key = len(values)
+            index[value] = key
+            values.append(value)
+        return key
+
+    def update(self, conversation_id, user_id, read_at, message_id):
+        """Record a read, keeping it only if it is later than the known one."""
+        key = (
+            self._intern(conversation_id, self._conversation_index, self._conversations) << 32
+            | self._intern(user_id, self._user_index, self._users)
+        )
+        micros = (read_at - EPOCH) // ONE_MICROSECOND
+        existing = self._entries.get(key)
+        if existing is not None and micros <= _micros(existing):
+            return
+
+        self._entries[key] = _VALUE.pack(micros, message_id.bytes)
+        if existing is None and len(self._entries) >= self.max_entries:
+            self.spill()
+
+    def spill(self):
+        """Write the in-memory table to a sorted run file and clear it."""
+        if not self._entries:
+            return
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="read-receipts-")
+            self._owns_spill_dir = True
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        # Runs are numbered, so a store restored from an older checkpoint
+        # simply overwrites the runs written after that checkpoint.
+        path = os.path.join(self.spill_dir, f"run-{len(self._runs):05d}.bin")
+        _write_run(path, self._sorted_memory())
+
+        self._runs.append(path)
+        self.spilled += len(self._entries)
+        self._entries.clear()
+        # Ids are only interned for the entries in memory; start afresh so
+        # the tables stay small, also in checkpoints.
+        self._conversation_index = {}
+        self._conversations = []
+        self._user_index = {}
+        self._users = []
+
+    def items(self):
+        """Yield the latest read per key, sorted by conversation and user."""
+        return iter_read_receipts([self])
+
+    def cleanup(self):
+        """Remove spill files if the store created its own directory."""
+        if self._owns_spill_dir and self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def _sorted_memory(self):
+        conversations = self._conversations
+        users = self._users
+        return sorted(
+            (conversations[key >> 32], users[key & 0xFFFFFFFF], value)
+            for key, value in self._entries.items()
+        )
+
+    def _sorted_records(self):
+        return [_read_run(path) for path in self._runs] + [iter(self._sorted_memory())]
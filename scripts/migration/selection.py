@@ -0,0 +1,82 @@
+"""
+Selective migration filters (--since, --until, --conversation-ids).
+
+Shared by migrate_messages.py and migrate_conversations.py. A selection is
+turned into a plain MongoDB filter so the server answers it from an index
+(the `_id` index or one on the time field / conversation id) instead of a
+collection scan, which lets a targeted repair read only the documents it
+rewrites.
+"""
+
+from datetime import datetime, timezone
+
+from bson import ObjectId
+
+# Fields a time window may be applied to: the source's creation time, or the
+# timestamp embedded in the ObjectId (always indexed).
+TIME_FIELDS = ("created_at", "_id")
+
+
+def parse_time(text):
+    """
+    Parse an ISO 8601 date or datetime for --since/--until.
+
+    Values without a timezone are taken as UTC.
+    """
+    try:
+        value = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"not an ISO 8601 date or datetime: {text!r}") from None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def load_conversation_ids(path):
+    """
+    Read conversation ids, one per line, from `path`.
+
+    Blank lines and lines starting with "#" are skipped; duplicates are
+    dropped, keeping the first occurrence.
+    """
+    with open(path, "r", encoding="utf-8") as fh:
+        ids = (line.strip() for line in fh)
+        return list(dict.fromkeys(value for value in ids if value and not value.startswith("#")))
+
+
+def time_window_query(field, since=None, until=None):
+    """
+    Build a MongoDB filter for `since <= field < until` (either bound optional).
+
+    For `field="_id"` the bounds are converted to ObjectIds, so the window
+    is answered from the `_id` index whatever other indexes exist.
+    """
+    condition = {}
+    if since is not None:
+        condition["$gte"] = ObjectId.from_datetime(since) if field == "_id" else since
+    if until is not None:
+        condition["$lt"] = ObjectId.from_datetime(until) if field == "_id" else until
+    return {field: condition} if condition else {}
+
+
+def combine_queries(*queries):
+    """AND together MongoDB filters, skipping empty ones."""
+    queries = [query for query in queries if query]
+    if not queries:
+        return {}
+    if len(queries) == 1:
+        return queries[0]
+    return {"$and": queries}
+
+
+def describe_selection(since, until, field, conversation_ids):
+    """One-line summary of a selection for the run header, or "all"."""
+    parts = []
+    if since is not None or until is not None:
+        parts.append(
+            f"{field} in [{since.isoformat() if since else '-inf'}, "
+            f"{until.isoformat() if until else '+inf'})"
+        )
+    if conversation_ids is not None:
+        parts.append(f"{len(conversation_ids)} conversations")
+    return ", ".join(parts) or "all"
@@ -0,0 +1,92 @@
+"""
+Split a MongoDB collection scan into `_id` ranges and run each range in its
+own worker process.
+
+Shared by migrate_messages.py and migrate_conversations.py. Split points are
+taken from a `$sample` of `_id` values, so ranges hold roughly the same number
+of documents even when inserts were bursty over time.
+"""
+
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Number of sampled `_id` values per requested range used to pick split points.
+SAMPLES_PER_WORKER = 64
+
+
+def split_id_ranges(collection, workers, samples_per_worker=SAMPLES_PER_WORKER):
+    """
+    Return up to `workers` contiguous (lower, upper) `_id` bounds.
+
+    Bounds are half-open (`lower <= _id < upper`); None means unbounded, so
+    the ranges always cover the whole collection. Fewer ranges are returned
+    when the sample is too small to produce distinct split points.
+    """
+    if workers <= 1:
+        return [(None, None)]
+
+    pipeline = [
+        {"$sample": {"size": workers * samples_per_worker}},
+        {"$project": {"_id": 1}},
+    ]
+    ids = sorted(doc["_id"] for doc in collection.aggregate(pipeline, allowDiskUse=True))
+
+    split_points = []
+    for i in range(1, workers):
+        index = i * len(ids) // workers
+        if index >= len(ids):
+            break
+        candidate = ids[index]
+        if not split_points or candidate > split_points[-1]:
+            split_points.append(candidate)
+
+    bounds = [None] + split_points + [None]
+    ranges = list(zip(bounds[:-1], bounds[1:]))
+    logger.info("Split '%s' into %d _id ranges", collection.name, len(ranges))
+    return ranges
+
+
+def id_range_query(id_range, after=None):
+    """
+    Build a MongoDB filter for a (lower, upper) `_id` range.
+
+    When `after` is given (a resumed scan), the lower bound is replaced by
+    `_id > after`.
+    """
+    lower, upper = id_range if id_range is not None else (None, None)
+    condition = {}
+    if after is not None:
+        condition["$gt"] = after
+    elif lower is not None:
+        condition["$gte"] = lower
+    if upper is not None:
+        condition["$lt"] = upper
+    return {"_id": condition} if condition else {}
+
+
+def run_sharded(worker, args, ranges):
+    """
+    Call `worker(args, shard_index, id_range, label)` for every range in a
+    process pool.
+
+    Workers are started with the "spawn" method so each one opens its own
+    MongoDB client and database sessions instead of inheriting forked
+    sockets. Results are returned in range order.
+    """
+    context = multiprocessing.get_context("spawn")
+    count = len(ranges)
+
+    with ProcessPoolExecutor(max_workers=count, mp_context=context) as pool:
+        futures = [
+            pool.submit(worker, args, i, id_range, f"shard {i + 1}/{count}")
+            for i, id_range in enumerate(ranges)
+        ]
+        return [future.result() for future in futures]
+
+
+def merge_counts(results):
+    """Sum per-worker count tuples element-wise."""
+    return tuple(sum(values) for values in zip(*results))
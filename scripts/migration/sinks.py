@@ -0,0 +1,312 @@
+"""
+Non-database write targets ("sinks") for the migration scripts.
+
+Both scripts hand their mapped rows to a sink instead of a database
+connection (--sink). Besides the ScyllaDB and PostgreSQL sinks defined in
+the scripts themselves there are:
+
+  - NullSink: counts and drops rows, to measure extract + transform alone;
+  - FileSink: writes one file per target table and process under
+    <export dir>/<table>/, ready for the bulk loaders:
+
+      ScyllaDB tables as CSV with a header row, NULL written as \\N (text
+      that is literally \\N, \\\\N, ... gets one more backslash):
+          cqlsh> COPY quckapp.messages (<header columns>) FROM 'part.csv'
+                 WITH HEADER = true AND NULL = '\\N'
+                 AND DATETIMEFORMAT = '%Y-%m-%d %H:%M:%S.%f%z';
+      PostgreSQL tables in COPY text format:
+          COPY messaging.conversations (<columns>)
+              FROM PROGRAM 'gzip -dc part.tsv.gz';
+
+Each script's --load-export mode streams such files back into its database
+through memory-mapped reads (iter_export_lines), so one MongoDB scan can
+feed several load attempts.
+"""
+
+import csv
+import glob
+import gzip
+import io
+import mmap
+import os
+import re
+import threading
+import zlib
+from datetime import datetime
+
+from metrics import ROWS_WRITTEN
+from throttle import WriteController
+
+SINKS = ("db", "null", "file")
+COMPRESSIONS = ("gzip", "none")
+
+# Favour scan throughput over file size; level 1 still shrinks text ~5x.
+EXPORT_COMPRESSLEVEL = 1
+
+# Bytes read from the memory map per decompression step.
+READ_CHUNK = 1 << 20
+
+NULL = "\\N"
+CSV_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f%z"
+
+_SET_ITEM = re.compile(r"'((?:[^']|'')*)'")
+
+# Text values that would read back as NULL, or as one with a backslash
+# less: CSV has no escapes, so csv_text adds a backslash to these.
+_NULL_LIKE = re.compile(r"\\+N")
+
+
+# ---------------------------------------------------------------------------
+# Value encoding
+# ---------------------------------------------------------------------------
+
+def csv_text(value):
+    """Render a value for cqlsh COPY FROM (see CSV_DATETIME_FORMAT and NULL)."""
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return "True" if value else "False"
+    if isinstance(value, datetime):
+        return value.strftime(CSV_DATETIME_FORMAT)
+    if isinstance(value, (set, frozenset, list, tuple)):
+        return "{" + ", ".join("'" + str(item).replace("'", "''") + "'" for item in sorted(value)) + "}"
+    text = str(value)
+    # A literal \N would load as NULL; read_csv_export strips the extra
+    # backslash again (cqlsh keeps it, as it has no escape for the marker).
+    return "\\" + text if _NULL_LIKE.fullmatch(text) else text
+
+
+def parse_csv_text(text):
+    """Undo csv_text for a text field: NULL for the marker, escapes removed."""
+    if text == NULL:
+        return None
+    return text[1:] if _NULL_LIKE.fullmatch(text) else text
+
+
+def parse_csv_timestamp(text):
+    """Parse a timestamp written by csv_text."""
+    return datetime.strptime(text, CSV_DATETIME_FORMAT)
+
+
+def parse_csv_set(text):
+    """Parse a CQL set literal written by csv_text into a set of strings."""
+    return {item.replace("''", "'") for item in _SET_ITEM.findall(text)}
+
+
+def copy_text(value):
+    """
+    Render a value in PostgreSQL COPY text format.
+
+    Backslashes are escaped before anything else, so a text value that is
+    literally \\N is written as \\\\N and never taken for the NULL marker.
+    """
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+_COPY_ESCAPES = {"\\\\": "\\", "\\t": "\t", "\\n": "\n", "\\r": "\r"}
+_COPY_ESCAPE = re.compile(r"\\[\\tnr]")
+
+
+def parse_copy_line(line):
+    """Split one COPY text-format line into values (None for NULL)."""
+    # The marker is compared with the raw field, before escapes are undone.
+    return [
+        None if field == NULL else _COPY_ESCAPE.sub(lambda match: _COPY_ESCAPES[match.group()], field)
+        for field in line.split("\t")
+    ]
+
+
+# ---------------------------------------------------------------------------
+# Sinks
+# ---------------------------------------------------------------------------
+
+class NullSink:
+    """
+    Sink that only counts rows.
+
+    Implements the interface the scripts expect of every sink: `write`,
+    `write_batch`, `mark`, `acknowledged`, `drain`, `close`, `controller`
+    and `in_flight`. Rows are done with once `write` returns.
+    """
+
+    def __init__(self, controller=None):
+        self.controller = controller or WriteController("export", 1, target_latency=None)
+        self.in_flight = 0
+        self.rows = 0
+        self._acknowledged = None
+
+    def write(self, table, partition_key, rows, source_ids=()):
+        """Take `rows` of `table`; `partition_key` is only used by ScyllaDB."""
+        self.controller.throttle(len(rows))
+        self.rows += len(rows)
+        ROWS_WRITTEN.labels(table).inc(len(rows))
+
+    def write_batch(self, tables, source_ids=()):
+        """Take {table: rows} in order, as one batch."""
+        for table, rows in tables.items():
+            if rows:
+                self.write(table, None, rows, source_ids)
+
+    def mark(self, tag):
+        self._acknowledged = tag
+
+    def acknowledged(self):
+        return self._acknowledged
+
+    def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSink(NullSink):
+    """
+    Sink writing one file per table under `directory`/<table>/<name>.
+
+    `tables` maps each table to (columns, encoding), where encoding is
+    "csv" (cqlsh COPY) or "copy" (PostgreSQL COPY text format). Rows may be
+    tuples in column order or dicts keyed by column; writes from several
+    threads are serialized. Files are appended to, so a resumed run
+    continues them; `mark` flushes every file first, so a checkpoint never
+    runs ahead of the data on disk.
+    """
+
+    def __init__(self, directory, name, tables, compression="gzip", controller=None):
+        super().__init__(controller)
+        self.directory = directory
+        self.name = name
+        self.tables = tables
+        self.compression = compression
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def _open(self, table):
+        columns, encoding = self.tables[table]
+        extension = ".csv" if encoding == "csv" else ".tsv"
+        if self.compression == "gzip":
+            extension += ".gz"
+        os.makedirs(os.path.join(self.directory, table), exist_ok=True)
+        path = os.path.join(self.directory, table, self.name + extension)
+        new = not os.path.exists(path)
+        if self.compression == "gzip":
+            raw = gzip.GzipFile(path, "ab", compresslevel=EXPORT_COMPRESSLEVEL)
+        else:
+            raw = open(path, "ab")
+        text = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+        writer = csv.writer(text, lineterminator="\n") if encoding == "csv" else None
+        if writer is not None and new:
+            writer.writerow(columns)
+        handle = self._files[table] = (raw, text, writer, columns)
+        return handle
+
+    def write(self, table, partition_key, rows, source_ids=()):
+        self.controller.throttle(len(rows))
+        with self._lock:
+            raw, text, writer, columns = self._files.get(table) or self._open(table)
+            if rows and isinstance(rows[0], dict):
+                rows = [[row[column] for column in columns] for row in rows]
+            if writer is not None:
+                writer.writerows([csv_text(value) for value in row] for row in rows)
+            else:
+                text.write("".join("\t".join(copy_text(value) for value in row) + "\n" for row in rows))
+            self.rows += len(rows)
+        ROWS_WRITTEN.labels(table).inc(len(rows))
+
+    def mark(self, tag):
+        with self._lock:
+            for raw, text, _, _ in self._files.values():
+                text.flush()
+                raw.flush()
+        self._acknowledged = tag
+
+    def close(self):
+        for _, text, _, _ in self._files.values():
+            text.close()
+        self._files = {}
+
+
+def check_export_dir(directory, resume):
+    """Refuse to append a fresh run to files left by an earlier one."""
+    if not resume and glob.glob(os.path.join(directory, "*", "*")):
+        raise RuntimeError(
+            f"Export directory {directory} already holds files; remove them or pass --resume"
+        )
+
+
+# ---------------------------------------------------------------------------
+# Reading exports back
+# ---------------------------------------------------------------------------
+
+def export_files(directory, table):
+    """Export files of `table` under `directory`, in name order."""
+    return sorted(
+        path for path in glob.glob(os.path.join(directory, table, "*"))
+        if path.endswith((".csv", ".tsv", ".csv.gz", ".tsv.gz"))
+    )
+
+
+def _gunzip(mapped):
+    """Decompress every gzip member in `mapped`, chunk by chunk."""
+    decompressor = zlib.decompressobj(wbits=31)
+    for offset in range(0, len(mapped), READ_CHUNK):
+        data = mapped[offset:offset + READ_CHUNK]
+        while data:
+            yield decompressor.decompress(data)
+            if not decompressor.eof:
+                break
+            # An appended run starts a new gzip member.
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(wbits=31)
+    yield decompressor.flush()
+
+
+def iter_export_lines(path):
+    """
+    Yield the lines of an export file as str, line endings kept.
+
+    The file is memory-mapped rather than read into buffers, so the page
+    cache serves repeated loads of the same export directly.
+    """
+    with open(path, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if path.endswith(".gz"):
+                chunks = _gunzip(mapped)
+            else:
+                chunks = (mapped[offset:offset + READ_CHUNK] for offset in range(0, len(mapped), READ_CHUNK))
+            pending = b""
+            for chunk in chunks:
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    yield line.decode("utf-8") + "\n"
+            if pending:
+                yield pending.decode("utf-8")
+
+
+def read_csv_export(path):
+    """Return (columns, rows) of a CSV export; values are str, None for NULL."""
+    reader = csv.reader(iter_export_lines(path))
+    columns = next(reader, [])
+    rows = ([parse_csv_text(value) for value in row] for row in reader)
+    return columns, rows
+
+
+def read_copy_export(path):
+    """Yield the rows of a COPY text-format export as lists of str or None."""
+    for line in iter_export_lines(path):
+        yield parse_copy_line(line.rstrip("\n"))
@@ -0,0 +1,215 @@
+"""
+Write-rate control for the migration scripts.
+
+`WriteController` combines an AIMD (additive increase, multiplicative
+decrease) controller with a token bucket:
+
+  - every completed write reports its latency; once per window of
+    completions the 90th percentile is compared with the target latency,
+    and the concurrency limit and batch size grow by one step when it is
+    met, or shrink by a factor when it is not;
+  - timeouts and overloaded errors shrink them immediately;
+  - the token bucket caps rows per second at --max-rows-per-second.
+
+Limits can be changed while a run is in progress by editing the JSON
+--control-file, e.g. {"max_rows_per_second": 5000, "max_in_flight": 32};
+every process of the run re-reads it within a few seconds.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from metrics import BATCH_SCALE, CONCURRENCY_LIMIT, RATE_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# Quantile of the latency window compared with the target latency.
+LATENCY_QUANTILE = 0.9
+
+# Smallest number of completions evaluated together.
+MIN_WINDOW = 8
+
+# Multiplicative decrease after a slow window, and after an overload error.
+SLOW_FACTOR = 0.7
+OVERLOAD_FACTOR = 0.5
+
+# Additive increase of the batch scale per good window.
+BATCH_SCALE_STEP = 0.05
+MIN_BATCH_SCALE = 0.05
+
+# Seconds after a decrease during which further decreases are ignored, so a
+# single slow spike is not counted once per request that was in flight.
+DECREASE_COOLDOWN = 1.0
+
+# Seconds between two checks of the control file.
+CONTROL_FILE_INTERVAL = 2.0
+
+
+class TokenBucket:
+    """Rows-per-second ceiling with a one-second burst; None means unlimited."""
+
+    def __init__(self, rate=None):
+        self._lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate if rate else None
+            self._tokens = self.rate or 0.0
+            self._last = time.monotonic()
+
+    def acquire(self, amount):
+        """Take `amount` tokens, sleeping for as long as the bucket is in debt."""
+        with self._lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+class WriteController:
+    """
+    Concurrency limit, batch size scale and rate ceiling for one target.
+
+    With `adaptive=False` the limits stay at their configured values and
+    only the rate ceiling and the control file apply.
+    """
+
+    def __init__(self, target, max_in_flight, target_latency, adaptive=False,
+                 max_rows_per_second=None, rate_share=1):
+        self.target = target
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.rate_share = rate_share
+        self.max_in_flight = max_in_flight
+        # Start low and let additive increase find the cluster's capacity.
+        self.in_flight_limit = max(1, max_in_flight // 4) if adaptive else max_in_flight
+        self.batch_scale = 0.5 if adaptive else 1.0
+        self.bucket = TokenBucket()
+        self._lock = threading.Lock()
+        self._window = []
+        self._last_decrease = 0.0
+        self.set_rate(max_rows_per_second)
+        self._publish()
+
+    def batch_limit(self, batch_size):
+        """Rows to buffer before a flush, for a configured `batch_size`."""
+        return max(1, int(batch_size * self.batch_scale))
+
+    def throttle(self, rows):
+        """Block until `rows` more rows may be written."""
+        self.bucket.acquire(rows)
+
+    def set_rate(self, max_rows_per_second):
+        """Set the run-wide rows/s ceiling (None for unlimited)."""
+        rate = max_rows_per_second / self.rate_share if max_rows_per_second else None
+        self.bucket.set_rate(rate)
+        RATE_LIMIT.labels(self.target).set(rate or 0)
+
+    def set_max_in_flight(self, max_in_flight):
+        with self._lock:
+            self.max_in_flight = max(1, max_in_flight)
+            if not self.adaptive or self.in_flight_limit > self.max_in_flight:
+                self.in_flight_limit = self.max_in_flight
+        self._publish()
+
+    def record(self, latency):
+        """Report the latency in seconds of a successful write."""
+        if not self.adaptive:
+            return
+        with self._lock:
+            self._window.append(latency)
+            if len(self._window) < max(MIN_WINDOW, self.in_flight_limit):
+                return
+            window = sorted(self._window)
+            self._window = []
+            observed = window[min(len(window) - 1, int(len(window) * LATENCY_QUANTILE))]
+            if observed > self.target_latency:
+                self._decrease(SLOW_FACTOR, f"p90 latency {observed * 1000:.0f} ms")
+            else:
+                self.in_flight_limit = min(self.max_in_flight, self.in_flight_limit + 1)
+                self.batch_scale = min(1.0, self.batch_scale + BATCH_SCALE_STEP)
+        self._publish()
+
+    def overloaded(self, reason):
+        """Report a timeout or overloaded error from the target."""
+        if not self.adaptive:
+            return
+        with self._lock:
+            self._window = []
+            self._decrease(OVERLOAD_FACTOR, reason)
+        self._publish()
+
+    def _decrease(self, factor, reason):
+        now = time.monotonic()
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self.in_flight_limit = max(1, int(self.in_flight_limit * factor))
+        self.batch_scale = max(MIN_BATCH_SCALE, self.batch_scale * factor)
+        logger.info(
+            "Backing off %s writes (%s): %d in flight, batch scale %.2f",
+            self.target, reason, self.in_flight_limit, self.batch_scale,
+        )
+
+    def _publish(self):
+        CONCURRENCY_LIMIT.labels(self.target).set(self.in_flight_limit)
+        BATCH_SCALE.labels(self.target).set(self.batch_scale)
+
+    def apply(self, settings):
+        """Apply settings read from the control file."""
+        if "max_rows_per_second" in settings:
+            self.set_rate(settings["max_rows_per_second"])
+        if settings.get("max_in_flight"):
+            self.set_max_in_flight(int(settings["max_in_flight"]))
+        if settings.get("target_latency_ms"):
+            self.target_latency = settings["target_latency_ms"] / 1000
+        logger.info("Applied control settings to %s writes: %s", self.target, settings)
+
+
+def watch_control_file(path, controller, interval=CONTROL_FILE_INTERVAL):
+    """Re-apply `path` to `controller` from a daemon thread whenever it changes."""
+    def run():
+        last_mtime = None
+        while True:
+            try:
+                mtime = os.stat(path).st_mtime
+                if mtime != last_mtime:
+                    with open(path, "r", encoding="utf-8") as fh:
+                        settings = json.load(fh)
+                    last_mtime = mtime
+                    controller.apply(settings)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as exc:
+                logger.warning("Ignoring control file %s: %s", path, exc)
+            time.sleep(interval)
+
+    threading.Thread(target=run, name="control-file", daemon=True).start()
+
+
+def controller_from_args(args, target, rate_share=1):
+    """
+    Build the WriteController configured by the common CLI flags.
+
+    `rate_share` splits --max-rows-per-second between that many processes.
+    """
+    controller = WriteController(
+        target,
+        getattr(args, "max_in_flight", 1),
+        args.target_latency_ms / 1000,
+        adaptive=args.adaptive,
+        max_rows_per_second=args.max_rows_per_second,
+        rate_share=rate_share,
+    )
+    if args.control_file:
+        watch_control_file(args.control_file, controller)
+    return controller
@@ -0,0 +1,168 @@
+"""
+Content verification helpers shared by the migration scripts.
+
+Each side of a migration is reduced to an order-independent digest per key
+(a conversation): the number of rows and the sum, modulo 2**64, of a 64-bit
+hash of every row. Rows are hashed in a canonical form, so a value read back
+from the target (naive UTC datetimes, driver set types, UUID objects, parsed
+JSON) hashes the same as the value that was written. Digests of disjoint
+shards or token ranges merge by addition, which lets both sides be computed
+in parallel and compared without sorting or diffing whole tables.
+"""
+
+import hashlib
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_MILLISECOND = timedelta(milliseconds=1)
+
+# Murmur3Partitioner token bounds used by ScyllaDB.
+MIN_TOKEN = -(2 ** 63)
+MAX_TOKEN = 2 ** 63 - 1
+
+# Number of token ranges a full-table scan is split into.
+DEFAULT_TOKEN_RANGES = 256
+
+# Mismatching keys logged individually before the report is truncated.
+MAX_REPORTED_MISMATCHES = 50
+
+_MASK = 2 ** 64 - 1
+
+
+def canonical(value):
+    """Normalise a column value so both databases hash it identically."""
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        # Both MongoDB dates and ScyllaDB timestamps have millisecond precision.
+        return {"$ts": (value - EPOCH) // ONE_MILLISECOND}
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, dict):
+        return {str(key): canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    # Sets (Python or driver types): order carries no meaning.
+    return sorted((canonical(item) for item in value), key=repr)
+
+
+def row_hash(table, row):
+    """64-bit hash of `row` (a sequence of column values) in `table`."""
+    payload = json.dumps([table, canonical(row)], sort_keys=True, separators=(",", ":"))
+    return int.from_bytes(hashlib.blake2b(payload.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class DigestTable:
+    """Order-independent (row count, hash sum) per key."""
+
+    def __init__(self):
+        self.digests = {}
+
+    def __len__(self):
+        return len(self.digests)
+
+    def add(self, key, table, row):
+        count, total = self.digests.get(key, (0, 0))
+        self.digests[key] = (count + 1, (total + row_hash(table, row)) & _MASK)
+
+    def update(self, other):
+        """Merge the digests of a disjoint part of the same data set."""
+        for key, (count, total) in other.digests.items():
+            own_count, own_total = self.digests.get(key, (0, 0))
+            self.digests[key] = (own_count + count, (own_total + total) & _MASK)
+        return self
+
+    def mismatches(self, other):
+        """Yield (key, expected rows, actual rows) for keys whose digests differ."""
+        for key in self.digests.keys() | other.digests.keys():
+            expected = self.digests.get(key, (0, 0))
+            actual = other.digests.get(key, (0, 0))
+            if expected != actual:
+                yield key, expected[0], actual[0]
+
+
+def merge_digests(tables):
+    """Merge DigestTables computed over disjoint shards."""
+    merged = DigestTable()
+    for table in tables:
+        merged.update(table)
+    return merged
+
+
+def token_ranges(count=DEFAULT_TOKEN_RANGES):
+    """
+    Split the Murmur3 token ring into `count` ranges (start, end].
+
+    Scans use `token(pk) > start AND token(pk) <= end`; the minimum token is
+    never assigned to a partition, so the first range loses nothing.
+    """
+    span = (MAX_TOKEN - MIN_TOKEN) // count
+    bounds = [MIN_TOKEN + span * i for i in range(count)] + [MAX_TOKEN]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def report_counts(label, counts):
+    """
+    Log the row counts in `counts` ({description: count}) and whether they agree.
+
+    Returns True when every count is the same.
+    """
+    width = max(len(name) for name in counts)
+    for name, count in counts.items():
+        logger.info("%s: %d", name.ljust(width), count)
+    if len(set(counts.values())) <= 1:
+        logger.info("%s counts MATCH", label)
+        return True
+    logger.warning(
+        "%s count MISMATCH: %s", label, ", ".join(f"{name}={count}" for name, count in counts.items()),
+    )
+    return False
+
+
+def report_mismatches(expected, actual, label):
+    """Log the keys whose digests differ; returns the number of mismatches."""
+    mismatched = 0
+    for key, expected_rows, actual_rows in expected.mismatches(actual):
+        mismatched += 1
+        if mismatched <= MAX_REPORTED_MISMATCHES:
+            logger.warning(
+                "%s MISMATCH for %s: source %d rows, target %d rows",
+                label, key, expected_rows, actual_rows,
+            )
+
+    if mismatched > MAX_REPORTED_MISMATCHES:
+        logger.warning("... %d more mismatching keys not shown", mismatched - MAX_REPORTED_MISMATCHES)
+    if mismatched:
+        logger.warning(
+            "%s content MISMATCH: %d of %d keys differ",
+            label, mismatched, len(expected.digests.keys() | actual.digests.keys()),
+        )
+    else:
+        logger.info("%s content MATCH across %d keys", label, len(expected))
+    return mismatched
+
+
+def check_results(args, target, verify_counts, verify_content):
+    """
+    Run the checks requested with --verify (`verify_counts`, True when the
+    counts match) and --verify-content (`verify_content`, the number of
+    mismatching keys); raises RuntimeError naming those that failed.
+    """
+    failed = []
+    if args.verify and not verify_counts():
+        failed.append("row counts")
+    if args.verify_content and verify_content():
+        failed.append("content digests")
+    if failed:
+        raise RuntimeError(f"Verification failed: {' and '.join(failed)} differ between MongoDB and {target}")